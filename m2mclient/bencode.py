@@ -5,8 +5,6 @@ Somewhat optimized over original in m2md
 
 """
 
-import io
-
 from operator import itemgetter
 
 from .lrucache import LRUCache
@@ -20,6 +18,15 @@ class DecodeError(Exception):
     """An error occurred when decoding bencode."""
 
 
+class IncompleteData(DecodeError):
+    """The data ended before the end of a value."""
+
+    def __init__(self, msg, needed=None):
+        super(IncompleteData, self).__init__(msg)
+        # Minimum size of the data before the value could be complete
+        self.needed = needed
+
+
 def encode(obj):
     """
     Encode data in to bencode, return bytes.
@@ -64,7 +71,55 @@ def encode(obj):
     return b''.join(binary)
 
 
-def decode(data, _cache=LRUCache(1000), make_string=bytes.decode):
+def scan(data, pos=0, max_string_size=None):
+    """
+    Get the end position of the bencode value that starts at `pos`.
+
+    This checks the structure of the value without decoding it, so it
+    is much cheaper than `decode` if you only need to know where values
+    start and end.
+
+    Raises IncompleteData if `data` ends before the value does.
+
+    """
+    obj_type = data[pos:pos + 1]
+    if obj_type.isdigit():
+        colon = data.find(b':', pos)
+        if colon == -1:
+            if not data[pos:].isdigit():
+                raise DecodeError('illegal digits in size')
+            raise IncompleteData('truncated data', len(data) + 1)
+        size_bytes = data[pos:colon]
+        if not size_bytes.isdigit():
+            raise DecodeError('illegal digits in size')
+        size = int(size_bytes)
+        if max_string_size is not None and size > max_string_size:
+            raise DecodeError('string is too large ({} bytes)'.format(size))
+        end = colon + 1 + size
+    elif obj_type == b'i':
+        end = data.find(b'e', pos)
+        if end == -1:
+            raise IncompleteData('truncated data', len(data) + 1)
+        end += 1
+    elif obj_type == b'l' or obj_type == b'd':
+        pos += 1
+        while data[pos:pos + 1] != b'e':
+            pos = scan(data, pos, max_string_size)
+        end = pos + 1
+    elif not obj_type:
+        raise IncompleteData('truncated data', pos + 1)
+    else:
+        raise DecodeError('invalid digit')
+    if end > len(data):
+        raise IncompleteData('truncated data', end)
+    return end
+
+
+# Decoded small values, shared by all clients in the process
+DECODE_CACHE = LRUCache(1000)
+
+
+def decode(data, _cache=DECODE_CACHE, make_string=bytes.decode):
     """
     Decode bencode `data` which should be a bytes object.
 
@@ -74,49 +129,194 @@ def decode(data, _cache=LRUCache(1000), make_string=bytes.decode):
     if data in _cache:
         return _cache[data]
 
-    data_file = io.BytesIO(data)
-    read = data_file.read
-
-    def peek(count):
-        """Read count bytes, and put the file pointer back."""
-        pos = data_file.tell()
-        try:
-            return read(count)
-        finally:
-            data_file.seek(pos)
-    # A byte iterator.
-    iter_bytes = iter(lambda: read(1), b'')
-
-    def _decode():
-        obj_type = next(iter_bytes)
+    def _decode(pos):
+        """Decode the value at `pos`, return the value and end position."""
+        obj_type = data[pos:pos + 1]
         if obj_type.isdigit():
+            colon = data.find(b':', pos)
+            size_bytes = data[pos:colon]
+            if colon == -1 or not size_bytes.isdigit():
+                raise DecodeError('illegal size')
+            start = colon + 1
+            end = start + int(size_bytes)
+            if end > len(data):
+                raise DecodeError('truncated string')
             try:
-                # Max 999,999 bytes in a bencode string
-                size_bytes = obj_type + read(peek(6).index(b':'))
-                if not size_bytes.isdigit():
-                    raise DecodeError('illegal digits in size')
-                read(1)
-                return make_string(read(int(size_bytes)))
+                return make_string(data[start:end]), end
             except ValueError:
-                raise DecodeError('illegal size')
-        elif obj_type == b'e':
-            return None
+                raise DecodeError('illegal string')
         elif obj_type == b'i':
+            end = data.find(b'e', pos)
+            if end == -1:
+                raise DecodeError('unterminated integer')
             try:
                 # Arbitrary integer (including negative)
-                # max size -10**15-1 to 10**16-1
-                return int(read(peek(16).index(b'e')))
+                return int(data[pos + 1:end]), end + 1
             except ValueError:
                 raise DecodeError('invalid integer')
-            finally:
-                read(1)
         elif obj_type == b'l':
-            return list(iter(_decode, None))
+            obj = []
+            append = obj.append
+            pos += 1
+            while data[pos:pos + 1] != b'e':
+                value, pos = _decode(pos)
+                append(value)
+            return obj, pos + 1
         elif obj_type == b'd':
-            return {k: _decode() for k in iter(_decode, None)}
+            obj = {}
+            pos += 1
+            while data[pos:pos + 1] != b'e':
+                key, pos = _decode(pos)
+                obj[key], pos = _decode(pos)
+            return obj, pos + 1
+        elif not obj_type:
+            raise DecodeError('unexpected end of data')
         raise DecodeError('invalid digit')
 
-    obj = _decode()
+    obj, _end = _decode(0)
     if len(data) < 100:
         _cache[data] = obj
     return obj
+
+
+# Byte values used by the Decoder
+_LIST = ord('l')
+_DICT = ord('d')
+_INT = ord('i')
+_END = ord('e')
+_DIGITS = frozenset(b'0123456789')
+
+
+class Decoder(object):
+    """
+    An incremental bencode decoder.
+
+    Data may be fed in chunks of any size; complete values are returned
+    as soon as the data for them has arrived. Only data for the value
+    currently being decoded is kept between calls, and a DecodeError is
+    raised if that exceeds `max_value_size`, or if a string is larger
+    than `max_string_size`.
+
+    The position and container depth of the scan are kept between
+    calls, so each byte is scanned once however the data is split.
+
+    If `raw` is True, the encoded bytes for each value are returned
+    rather than the decoded value.
+
+    """
+
+    def __init__(self, max_string_size=16 * 1024 * 1024,
+                 max_value_size=32 * 1024 * 1024, raw=False):
+        self.max_string_size = max_string_size
+        self.max_value_size = max_value_size
+        self.raw = raw
+        self._buffer = bytearray()
+        # The buffer size required before the value may be complete
+        self._needed = 1
+        # Where to resume scanning, and the depth of nested containers
+        self._pos = 0
+        self._depth = 0
+
+    def __repr__(self):
+        return "<bencode decoder {} bytes pending>".format(self.pending)
+
+    @property
+    def pending(self):
+        """Number of bytes buffered for an incomplete value."""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Add data, and return a list of values completed by it."""
+        buffer = self._buffer
+        buffer += data
+        if len(buffer) < self._needed:
+            return []
+        values = []
+        append = values.append
+        buffer_size = len(buffer)
+        max_string_size = self.max_string_size
+        pos = self._pos
+        depth = self._depth
+        # Start of the current value
+        start = 0
+        needed = 1
+        try:
+            while pos < buffer_size:
+                token = buffer[pos]
+                if token == _LIST or token == _DICT:
+                    depth += 1
+                    pos += 1
+                elif token == _END:
+                    if not depth:
+                        raise DecodeError('invalid digit')
+                    depth -= 1
+                    pos += 1
+                elif token == _INT:
+                    end = buffer.find(b'e', pos)
+                    if end == -1:
+                        needed = buffer_size + 1
+                        break
+                    try:
+                        int(buffer[pos + 1:end])
+                    except ValueError:
+                        raise DecodeError('invalid integer')
+                    pos = end + 1
+                elif token in _DIGITS:
+                    colon = buffer.find(b':', pos)
+                    if colon == -1:
+                        if not buffer[pos:].isdigit():
+                            raise DecodeError('illegal digits in size')
+                        needed = buffer_size + 1
+                        break
+                    size_bytes = buffer[pos:colon]
+                    if not size_bytes.isdigit():
+                        raise DecodeError('illegal digits in size')
+                    size = int(size_bytes)
+                    if max_string_size is not None and \
+                            size > max_string_size:
+                        raise DecodeError(
+                            'string is too large ({} bytes)'.format(size)
+                        )
+                    end = colon + 1 + size
+                    if end > buffer_size:
+                        needed = end
+                        break
+                    pos = end
+                else:
+                    raise DecodeError('invalid digit')
+                if not depth:
+                    value_bytes = bytes(buffer[start:pos])
+                    append(value_bytes if self.raw else decode(value_bytes))
+                    start = pos
+            del buffer[:start]
+            self._pos = pos - start
+            self._depth = depth
+            self._needed = needed - start
+            if len(buffer) > self.max_value_size:
+                raise DecodeError(
+                    'value is too large (over {} bytes)'.format(
+                        self.max_value_size
+                    )
+                )
+        except DecodeError:
+            self.reset()
+            raise
+        return values
+
+    def close(self):
+        """Check there is no incomplete value."""
+        if self._buffer:
+            pending = self.pending
+            self.reset()
+            raise IncompleteData(
+                'data ended with {} bytes of an incomplete value'.format(
+                    pending
+                )
+            )
+
+    def reset(self):
+        """Discard any incomplete value."""
+        del self._buffer[:]
+        self._needed = 1
+        self._pos = 0
+        self._depth = 0
@@ -0,0 +1,168 @@
+"""
+Reusable receive buffers, and route data that refers to them.
+
+The lean transport receives frames in to bytearrays from a BufferPool,
+which are recycled rather than allocated for each connection or large
+frame. The pool is owned by the client, so buffers survive reconnects.
+
+With `route_views` enabled, route packets aren't decoded in to a new
+packet object and bytes. A RouteView is reused for every route packet
+on a connection, and `data` is a memoryview on the receive buffer. The
+view is only valid until the handler returns; use `retain(data)` to
+copy data that must be kept:
+
+    @expose(PacketType.route)
+    def handle_route(self, port, data):
+        self.pending.append(retain(data))
+
+"""
+
+import re
+from threading import Lock
+
+from .packets import PacketType
+from .packets import Route
+
+
+ROUTE_HEADER = re.compile(rb'li6ei(\d+)e(\d+):')
+
+
+def retain(data):
+    """Copy route data, if it is a view on a receive buffer."""
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+class BufferPool(object):
+    """A pool of bytearrays, in power of two size classes."""
+
+    def __init__(self, min_size=4096, max_buffers=4):
+        self.min_size = min_size
+        self.max_buffers = max_buffers
+        self.allocated = 0
+        self.reused = 0
+        self._lock = Lock()
+        # size -> [<bytearray>]
+        self._free = {}
+
+    def __repr__(self):
+        return "<buffer pool allocated={} reused={}>".format(
+            self.allocated,
+            self.reused
+        )
+
+    def get_size(self, size):
+        """Get the size of buffer that would be returned for `size`."""
+        size = max(size, self.min_size)
+        return 1 << (size - 1).bit_length()
+
+    def acquire(self, size):
+        """Get a buffer of at least `size` bytes."""
+        size = self.get_size(size)
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+        return bytearray(size)
+
+    def release(self, buffer):
+        """Return a buffer to the pool."""
+        size = len(buffer)
+        if size != self.get_size(size):
+            # Not one of ours
+            return
+        with self._lock:
+            free = self._free.setdefault(size, [])
+            if len(free) < self.max_buffers:
+                free.append(buffer)
+
+    def clear(self):
+        """Free all pooled buffers."""
+        with self._lock:
+            self._free.clear()
+
+    @property
+    def pooled_bytes(self):
+        """Total size of buffers in the pool."""
+        with self._lock:
+            return sum(
+                size * len(free) for size, free in self._free.items()
+            )
+
+
+class RouteView(object):
+    """
+    A route packet with data that refers to a receive buffer.
+
+    A single instance is loaded with each route packet, so it must not
+    be kept beyond the handler. Call `retain()` for a Route packet that
+    may be kept.
+
+    """
+
+    type = PacketType.route
+    attributes = Route.attributes
+
+    def __init__(self):
+        self.port = None
+        self.data = None
+        self._view = None
+
+    def __repr__(self):
+        if self.data is None:
+            return "RouteView()"
+        return "RouteView(port={}, data=<{} bytes>)".format(
+            self.port,
+            len(self.data)
+        )
+
+    def load(self, payload):
+        """
+        Refer to a route packet in `payload`.
+
+        Returns False if the payload isn't a well formed route packet,
+        and should be decoded normally.
+
+        """
+        match = ROUTE_HEADER.match(payload)
+        if match is None:
+            return False
+        start = match.end()
+        end = start + int(match.group(2))
+        if len(payload) != end + 1 or payload[end:] != b'e':
+            return False
+        self.port = int(match.group(1))
+        self._view = view = memoryview(payload)
+        self.data = view[start:end]
+        return True
+
+    def release(self):
+        """Release the view on the receive buffer."""
+        if self._view is not None:
+            try:
+                self.data.release()
+                self._view.release()
+            except BufferError:
+                # Something still holds a buffer from the data
+                pass
+            self.data = self._view = None
+
+    def retain(self):
+        """Get a Route packet with a copy of the data."""
+        return Route(self.port, self.data.tobytes())
+
+    @property
+    def kwargs(self):
+        """Keyword args to be used to invoke handler."""
+        return {'port': self.port, 'data': self.data}
+
+    @property
+    def as_bytes(self):
+        return b"li6ei%ie%i:%se" % (
+            self.port,
+            len(self.data),
+            self.data
+        )
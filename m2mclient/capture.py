@@ -0,0 +1,252 @@
+"""
+Capture and replay of M2M traffic.
+
+A capture file is a short header, followed by a record for each packet
+in the order it was sent or received:
+
+    <float64 timestamp> <uint8 direction> <uint32 size> <packet bytes>
+
+Captures are meant to be kept and shared, so secrets (the password in
+request_login and the value of command_set_auth) are replaced with
+`<redacted>`, unless the writer is created with `redact=False`.
+
+Captures may be replayed through the decoder and a dispatcher, either at
+the original speed or as fast as possible. From the command line:
+
+    python -m m2mclient.capture replay traffic.m2mcap --speed 1
+
+"""
+
+import logging
+import struct
+import threading
+import time
+from collections import Counter
+
+from .packetbase import PacketError
+from .packets import M2MPacket
+from .packets import PacketType
+
+
+log = logging.getLogger('m2m.capture')
+
+MAGIC = b'M2MCAP\x00\x01'
+RECORD = struct.Struct('<dBI')
+
+INBOUND = 0
+OUTBOUND = 1
+
+# The field to redact in packets that contain secrets
+REDACTED_FIELDS = {
+    PacketType.request_login: 'password',
+    PacketType.command_set_auth: 'value',
+}
+REDACTED = b'<redacted>'
+# Packets start with the packet type, so they can be spotted cheaply
+REDACTED_PREFIXES = tuple(
+    b'li%ie' % packet_type for packet_type in REDACTED_FIELDS
+)
+
+
+def redact(packet_bytes):
+    """Get packet bytes with any secrets replaced."""
+    if not bytes(packet_bytes[:8]).startswith(REDACTED_PREFIXES):
+        return packet_bytes
+    packet = M2MPacket.from_bytes(bytes(packet_bytes))
+    kwargs = packet.kwargs
+    kwargs[REDACTED_FIELDS[packet.type]] = REDACTED
+    return M2MPacket.create(packet.type, **kwargs).as_bytes
+
+
+class CaptureError(Exception):
+    """The capture file is invalid."""
+
+
+class CaptureWriter(object):
+    """Appends packets to a capture file."""
+
+    def __init__(self, path, redact=True):
+        self.path = path
+        self.redact = redact
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def __repr__(self):
+        return "CaptureWriter({!r})".format(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, direction, packet_bytes, timestamp=None):
+        """Record a packet sent (OUTBOUND) or received (INBOUND)."""
+        if self.redact:
+            packet_bytes = redact(packet_bytes)
+        header = RECORD.pack(
+            time.time() if timestamp is None else timestamp,
+            direction,
+            len(packet_bytes)
+        )
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(header)
+                self._file.write(packet_bytes)
+
+    def write_buffers(self, direction, buffers, timestamp=None):
+        """Record a packet that is encoded as a list of buffers."""
+        if self.redact:
+            head = b''.join(bytes(buffer[:8]) for buffer in buffers[:8])
+            if head.startswith(REDACTED_PREFIXES):
+                self.write(direction, b''.join(buffers), timestamp)
+                return
+        header = RECORD.pack(
+            time.time() if timestamp is None else timestamp,
+            direction,
+            sum(len(buffer) for buffer in buffers)
+        )
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(header)
+                for buffer in buffers:
+                    self._file.write(buffer)
+
+    def flush(self):
+        """Flush captured packets to disk."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        """Close the capture file."""
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """
+    Generate (<timestamp>, <direction>, <packet bytes>) from a capture.
+
+    A truncated record at the end of the file (if the capture was still
+    being written) is ignored.
+
+    """
+    with open(path, 'rb') as capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise CaptureError('{} is not a capture file'.format(path))
+        read = capture_file.read
+        record_size = RECORD.size
+        unpack = RECORD.unpack
+        while True:
+            header = read(record_size)
+            if len(header) < record_size:
+                break
+            timestamp, direction, size = unpack(header)
+            packet_bytes = read(size)
+            if len(packet_bytes) < size:
+                break
+            yield timestamp, direction, packet_bytes
+        if header:
+            log.warning('%s ends with a truncated record', path)
+
+
+def replay(path, dispatch=None, speed=None, direction=INBOUND):
+    """
+    Feed packets from a capture through the decoder.
+
+    `dispatch` is a callable that will receive each decoded packet, such
+    as the `dispatch_packet` method of a Dispatcher. If `speed` is None,
+    packets are replayed as fast as possible, otherwise it is a multiple
+    of the original speed. `direction` selects INBOUND or OUTBOUND
+    packets, or None for both.
+
+    Returns a dict of statistics.
+
+    """
+    stats = {
+        'packets': 0,
+        'bytes': 0,
+        'errors': 0,
+        'elapsed': 0.0,
+        'types': Counter(),
+    }
+    start_time = time.monotonic()
+    first_timestamp = None
+    from_bytes = M2MPacket.from_bytes
+    for timestamp, packet_direction, packet_bytes in read_capture(path):
+        if direction is not None and packet_direction != direction:
+            continue
+        if speed:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (
+                start_time +
+                (timestamp - first_timestamp) / speed -
+                time.monotonic()
+            )
+            if delay > 0:
+                time.sleep(delay)
+        stats['packets'] += 1
+        stats['bytes'] += len(packet_bytes)
+        try:
+            packet = from_bytes(packet_bytes)
+        except PacketError as error:
+            log.warning('bad packet in capture (%s)', error)
+            stats['errors'] += 1
+            continue
+        stats['types'][packet.type] += 1
+        if dispatch is not None:
+            try:
+                dispatch(packet)
+            except Exception:
+                log.exception('error dispatching %r', packet)
+                stats['errors'] += 1
+    stats['elapsed'] = time.monotonic() - start_time
+    return stats
+
+
+def main(argv=None):
+    """Replay a capture from the command line and report statistics."""
+    # Imported here, as the client imports this module
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m m2mclient.capture')
+    subparsers = parser.add_subparsers(dest='action')
+    replay_parser = subparsers.add_parser(
+        'replay', help='decode packets in a capture file'
+    )
+    replay_parser.add_argument('path')
+    replay_parser.add_argument(
+        '--speed', type=float, default=None,
+        help='multiple of original speed (default is as fast as possible)'
+    )
+    replay_parser.add_argument(
+        '--direction', choices=['in', 'out', 'both'], default='in'
+    )
+    args = parser.parse_args(argv)
+    if args.action != 'replay':
+        parser.print_usage()
+        return 2
+
+    direction = {'in': INBOUND, 'out': OUTBOUND, 'both': None}
+    stats = replay(
+        args.path,
+        speed=args.speed,
+        direction=direction[args.direction]
+    )
+    elapsed = stats['elapsed']
+    print('packets  {}'.format(stats['packets']))
+    print('bytes    {}'.format(stats['bytes']))
+    print('errors   {}'.format(stats['errors']))
+    print('elapsed  {:.3f}s'.format(elapsed))
+    if elapsed:
+        print('rate     {:.0f} packets/s'.format(stats['packets'] / elapsed))
+    for packet_type, count in stats['types'].most_common():
+        print('  {:<28}{}'.format(PacketType(packet_type).name, count))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,46 +1,80 @@
+import heapq
 import weakref
 import logging
 import socket
+import time
+from functools import lru_cache
+from functools import partial
+from threading import BoundedSemaphore
 from threading import Event
+from threading import Lock
 from threading import Thread
+from threading import current_thread
 
-from lomond import WebSocket
-from lomond.constants import USER_AGENT as LOMOND_USER_AGENT
-
+from .bufferpool import BufferPool
+from .bufferpool import RouteView
 from .dispatcher import Dispatcher
 from .dispatcher import PacketFormatError
 from .dispatcher import expose
+from .executors import FAST_LANE_PACKETS
+from .executors import InlineExecutor
+from .flowcontrol import FlowControl
+from .instructions import InstructionRegistry
+from .packetbase import PacketError
 from .packets import M2MPacket
 from .packets import PacketType
+from . import bencode
+from . import capture
+from .coalesce import WriteCoalescer
+from .outbound import OutboundScheduler
+from .rtt import RTTEstimator
+from .trace import PacketTrace
 from . import errors
 
 
 log = logging.getLogger('m2m')
 
 
+@lru_cache(maxsize=1)
+def get_agent():
+    """Get the user agent string, which identifies the host."""
+    # Deferred until we connect, as gethostname may be slow
+    from lomond.constants import USER_AGENT as LOMOND_USER_AGENT
+    return "{} {}".format(
+        socket.gethostname(),
+        LOMOND_USER_AGENT
+    )
+
 
 class WebSocketThread(Thread):
     """Websocket thread."""
 
-    AGENT = "{} {}".format(
-        socket.gethostname(),
-        LOMOND_USER_AGENT
-    )
+    # User agent, or None for the default from get_agent()
+    AGENT = None
 
     def __init__(self, url, client, on_startup=None):
         super().__init__()
-        self.ws = WebSocket(url, agent=self.AGENT)
+        self.url = url
+        self.ws = self.create_websocket(url)
         self._client = weakref.ref(client)
         self.on_startup = on_startup or (lambda: None)
         self.running = False
         self.ready_event = Event()
         self.error = None
         self.daemon = True
+        # Reused for every route packet, if the client has route_views
+        self.route_view = RouteView() if client.route_views else None
 
     @property
     def client(self):
         return self._client()
 
+    def create_websocket(self, url):
+        """Create the lomond websocket."""
+        # Lomond is imported here to keep `import m2mclient` fast
+        from lomond import WebSocket
+        return WebSocket(url, agent=self.AGENT or get_agent())
+
     def run(self):
         """Main thread loop."""
         try:
@@ -64,24 +98,59 @@ class WebSocketThread(Thread):
             self.ready_event.set()
 
     def on_binary(self, data):
-        """Called with a binary message."""
-        if not self.client:
+        """
+        Called with a binary message.
+
+        `data` may be bytes, or a memoryview that is only valid until
+        this returns.
+
+        """
+        client = self.client
+        if not client:
             log.warning('ws message %r ignored', data)
             return
-        try:
-            packet = M2MPacket.from_bytes(data)
-        except PacketFormatError as packet_error:
-            # We received a badly formatted packet from the server
-            # Inconceivable!
-            log.warning('bad packet (%s)', packet_error)
+        if client.capture is not None:
+            client.capture.write(capture.INBOUND, data)
+        route_view = self.route_view
+        if route_view is not None and route_view.load(data):
+            packet = route_view
         else:
-            log.debug(' <- %r', packet)
-            self.client.dispatcher.dispatch_packet(packet)
+            route_view = None
+            try:
+                packet = client.decode_packet(bytes(data))
+            except (PacketFormatError, PacketError) as packet_error:
+                # We received a badly formatted packet from the server
+                # Inconceivable!
+                log.warning('bad packet (%s)', packet_error)
+                return
+        try:
+            if client.trace.enabled:
+                client.trace.inbound(packet, len(data))
+            client.dispatch_packet(packet)
+        finally:
+            if route_view is not None:
+                route_view.release()
 
     def send(self, data):
         """Send binary message (low level interface)."""
         self.ws.send_binary(data)
 
+    def send_many(self, messages):
+        """Send a number of binary messages back to back."""
+        send_binary = self.ws.send_binary
+        for data in messages:
+            send_binary(data)
+
+    def send_buffers(self, buffers):
+        """
+        Send a binary message from a list of buffers.
+
+        Lomond frames a single bytes object, so the buffers are joined
+        here, once, rather than when the packet is encoded.
+
+        """
+        self.ws.send_binary(b''.join(buffers))
+
     def close(self):
         """Close the websocket."""
         self.ws.close()
@@ -94,9 +163,21 @@ class CommandResult(object):
 
     """
 
+    # Default for `get`, set by the client if timeouts are adaptive
+    timeout = 5
+
     def __init__(self, name):
         self.name = name
+        self.coalesce_key = None
+        self.deadline = None
+        # Monotonic times the command was sent, and the response arrived
+        self.sent_time = None
+        self.response_time = None
+        # Callable that sends the command again, for idempotent commands
+        self.hedge = None
+        self.hedged = False
         self._result = None
+        self._expired = False
         self._event = Event()
 
     def __repr__(self):
@@ -105,21 +186,47 @@ class CommandResult(object):
     def set(self, result):
         """Set the result from another thread."""
         log.debug('command result %r', result)
+        self.response_time = time.monotonic()
         self._result = result
         self._event.set()
 
-    def get(self, timeout=5):
+    def expire(self):
+        """Called when the command's deadline passed with no response."""
+        if self.response_time is None:
+            # A hedged command may have had a response to the other copy
+            self._expired = True
+        self._event.set()
+
+    @property
+    def done(self):
+        """True if there was a response, or the command expired."""
+        return self._event.is_set()
+
+    def get(self, timeout=None):
         """Get the result or throw a CommandTimeout error.
 
         In normal operation this should return in less than a second.
         Timeouts could occur if the m2m server is down, overloaded, or
         otherwise fubar.
+
+        If `timeout` is None, the client's timeout is used. That is 5
+        seconds, unless the client has `adaptive_timeout` set, in which
+        case it is computed from the round trip time of recent commands.
+        If the command can be hedged, it is sent once more after the
+        timeout, and the first response to either is used.
         """
-        # The default timeout of 5 seconds is probably unrealistically
-        # high Even under load the server response time should be
-        # measured in milliseconds
+        if timeout is None:
+            timeout = self.timeout
         if not self._event.wait(timeout):
-            raise errors.CommandTimeout('command timed out')
+            if self.hedge is None or self.hedged:
+                raise errors.CommandTimeout('command timed out')
+            self.hedged = True
+            log.debug('hedging %r after %.3fs', self, timeout)
+            self.hedge()
+            if not self._event.wait(timeout):
+                raise errors.CommandTimeout('command timed out')
+        if self._expired:
+            raise errors.CommandTimeout('command expired')
         if self._result is None:
             raise errors.CommandError(
                 'invalid response'
@@ -133,51 +240,321 @@ class CommandResult(object):
         return self._result
 
 
+class PreparedCommand(object):
+    """A command with some parameters encoded in advance."""
+
+    def __init__(self, client, name, template):
+        self._client = weakref.ref(client)
+        self.name = name
+        self.template = template
+
+    def __repr__(self):
+        return "PreparedCommand({!r})".format(self.name)
+
+    def __call__(self, *args, **kwargs):
+        """Send the command, return a CommandResult."""
+        client = self._client()
+        if client is None:
+            raise errors.ConnectionError('client has gone')
+        return client._send_command(
+            self.name, args, kwargs, template=self.template
+        )
+
+
 class M2MClient:
     """A client for the M2M protocol."""
 
-    def __init__(self, url, username, password, connect_wait=5):
-        self.url = url
+    # Commands with no side effects, which may share a single response
+    # when `coalesce_commands` is enabled
+    IDEMPOTENT_COMMANDS = frozenset([
+        PacketType.command_check_nodes,
+        PacketType.command_get_identities,
+        PacketType.command_get_meta,
+    ])
+
+    def __init__(self, url, username, password, connect_wait=5,
+                 coalesce_commands=False, command_timeout=5,
+                 max_pending_commands=None, capture_path=None,
+                 executor=None, route_sink=None, write_delay=None,
+                 write_max_bytes=16 * 1024, trace_sample=1,
+                 trace_structured=False, eager_connect=False,
+                 prioritize_outbound=False, flow_window=None,
+                 transport='lomond', socket_options=None, spool_path=None,
+                 spool_size=16 * 1024 * 1024, spool_policy='drop_new',
+                 spool_rate=None, failover_interval=None,
+                 failover_timeout=2, failover_misses=3,
+                 failover_max_rtt=None, adaptive_timeout=False,
+                 timeout_floor=0.05, timeout_ceiling=None,
+                 hedge_commands=False, route_views=False,
+                 outbound_max_bytes=None, outbound_timeout=5):
+        # A single url, or a list of endpoints to choose from
+        self.urls = [url] if isinstance(url, str) else list(url)
+        if not self.urls:
+            raise ValueError('no urls given')
+        self.url = self.urls[0]
         self.username = username
         self.password = password
         self.connect_wait = connect_wait
+        self.coalesce_commands = coalesce_commands
+        self.command_timeout = command_timeout
+        self.adaptive_timeout = adaptive_timeout
+        self.hedge_commands = hedge_commands
+        self.command_rtt = RTTEstimator(
+            floor=timeout_floor,
+            ceiling=timeout_ceiling or command_timeout
+        )
+        self.max_pending_commands = max_pending_commands
+        self.capture = (
+            capture.CaptureWriter(capture_path)
+            if capture_path else None
+        )
+        self.spool = None
+        if spool_path:
+            # Imported here, as shared memory is slow to import
+            from .spool import OutboundSpool
+            self.spool = OutboundSpool(
+                spool_path,
+                size=spool_size,
+                policy=spool_policy,
+                rate=spool_rate
+            )
+        self.eager_connect = eager_connect
+        if transport not in ('lomond', 'lean'):
+            raise ValueError("transport should be 'lomond' or 'lean'")
+        self.transport = transport
+        self.socket_options = socket_options
+        self.route_views = route_views
+        # Receive buffers, kept over reconnects
+        self.buffer_pool = BufferPool()
         self._identity = None
+        self._identity_lock = Lock()
+        # Commands waiting for our identity, if eager_connect is set
+        self._identity_queue = []
+        # Set while the queue is being sent, so new commands queue too
+        self._identity_draining = False
+        # Set when the server sets the identity for the latest login
+        self._session_event = Event()
         self.dispatcher = Dispatcher(M2MPacket, instance=self)
+        # Only an executor we created is shut down on exit
+        self._owns_executor = executor is None
+        self.executor = executor or InlineExecutor()
+        self.route_sink = route_sink
+        self.instructions = InstructionRegistry()
+        self.trace = PacketTrace(
+            log,
+            sample=trace_sample,
+            structured=trace_structured
+        )
+        self.outbound_timeout = outbound_timeout
+        self.outbound = (
+            OutboundScheduler(
+                self._write,
+                max_queued_bytes=outbound_max_bytes
+            )
+            if prioritize_outbound else None
+        )
+        self.flow_control = (
+            FlowControl(
+                self._send_data_packet,
+                self._send_control_packet,
+                window=flow_window
+            )
+            if flow_window else None
+        )
+        self.write_coalescer = (
+            WriteCoalescer(self._send_data, write_delay, write_max_bytes)
+            if write_delay else None
+        )
         self.command_id = 0
         self.command_events = {}
+        self._command_lock = Lock()
+        self._coalesced = {}
+        self._command_deadlines = []
+        self._sweep_stop = None
+        self._command_slots = (
+            BoundedSemaphore(max_pending_commands)
+            if max_pending_commands else None
+        )
+        # Commands that passed their deadline, and responses that
+        # arrived after that
+        self.expired_commands = 0
+        self.late_responses = 0
+        self.failover_interval = failover_interval
+        self.failover_timeout = failover_timeout
+        self.failover_misses = failover_misses
+        self.failover_max_rtt = failover_max_rtt
+        self.health = None
+        self._failover_lock = Lock()
         self.ws = None
         self.identity_event = Event()
         self.create_ws()
 
     def create_ws(self):
-        self.ws = WebSocketThread(
-            self.url,
-            self,
-            on_startup=self.on_startup
-        )
+        self.ws = self._create_ws(self.url)
+
+    def _create_ws(self, url):
+        """Create a websocket thread for a url."""
+        if self.transport == 'lean':
+            from .transport import LeanWebSocketThread
+            ws = LeanWebSocketThread(
+                url,
+                self,
+                socket_options=self.socket_options,
+                close_timeout=self.connect_wait,
+                buffer_pool=self.buffer_pool
+            )
+        else:
+            ws = WebSocketThread(url, self)
+        # The new connection logs in before it replaces self.ws
+        ws.on_startup = partial(self.on_startup, ws)
+        return ws
 
     def __enter__(self):
-        log.debug('connecting to %s', self.url)
-        self.ws.start()
-        self.ws.ready_event.wait(self.connect_wait)
-        if not self.ws.running:
-            raise errors.ConnectionError(
-                self.ws.error or 'unable to connect'
+        self.trace.refresh()
+        urls = self.urls
+        if len(urls) > 1:
+            from .endpoints import rank_endpoints
+            ranked = rank_endpoints(urls, self.failover_timeout)
+            # Try unresponsive endpoints last
+            urls = ranked + [url for url in urls if url not in ranked]
+        error = None
+        for url in urls:
+            error = self._connect(url)
+            if error is None:
+                break
+        else:
+            raise errors.ConnectionError(error)
+        if self.failover_interval and len(self.urls) > 1:
+            from .endpoints import HealthMonitor
+            self.health = HealthMonitor(
+                self,
+                interval=self.failover_interval,
+                timeout=self.failover_timeout,
+                misses=self.failover_misses,
+                max_rtt=self.failover_max_rtt
             )
+            self.health.start()
+        self._start_sweep()
         return self
 
+    def _start_sweep(self):
+        """Start a thread to expire commands when there is no traffic."""
+        self._sweep_stop = stop = Event()
+        Thread(
+            target=self._run_sweep,
+            args=(stop,),
+            name='m2m-sweep',
+            daemon=True
+        ).start()
+
+    def _run_sweep(self, stop):
+        """Sweep commands as they reach their deadline, until stopped."""
+        while True:
+            # New commands never have an earlier deadline than those in
+            # the heap, so waiting for the first deadline is enough
+            wait = self.command_timeout
+            with self._command_lock:
+                if self._command_deadlines:
+                    wait = min(
+                        wait,
+                        self._command_deadlines[0][0] - time.monotonic()
+                    )
+            if stop.wait(max(0, wait)):
+                break
+            self.sweep_commands()
+
+    def _connect(self, url):
+        """
+        Connect to a url, return None if successful or an error message.
+
+        The current connection is replaced only once the new one is up,
+        so it may be used until then.
+
+        """
+        log.debug('connecting to %s', url)
+        ws = self.ws
+        if url != self.url or ws.ident is not None:
+            # Threads can only be started once
+            ws = self._create_ws(url)
+        ws.start()
+        ws.ready_event.wait(self.connect_wait)
+        if not ws.running:
+            return ws.error or 'unable to connect'
+        self.ws = ws
+        self.url = url
+        return None
+
+    def failover(self):
+        """
+        Move the session to the fastest of the other endpoints.
+
+        Returns True if the client connected to another endpoint.
+
+        """
+        from .endpoints import rank_endpoints
+        with self._failover_lock:
+            old_ws = self.ws
+            old_url = self.url
+            urls = [
+                url
+                for url in rank_endpoints(self.urls, self.failover_timeout)
+                if url != old_url
+            ]
+            for url in urls:
+                log.info('failing over from %s to %s', old_url, url)
+                if self._connect(url) is None:
+                    break
+            else:
+                log.warning('no endpoints to fail over to')
+                if not old_ws.running:
+                    # Try to reconnect to the current endpoint
+                    return self._connect(old_url) is None
+                return False
+            try:
+                old_ws.close()
+            except Exception as error:
+                log.debug('error closing %s (%s)', old_url, error)
+            self.command_rtt.reset()
+            return True
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
+            if self.health is not None:
+                self.health.stop()
+            if self._sweep_stop is not None:
+                self._sweep_stop.set()
+                self._sweep_stop = None
+            if self.write_coalescer is not None:
+                self.write_coalescer.close(timeout=self.connect_wait)
+            if self.outbound is not None:
+                self.outbound.close(timeout=self.connect_wait)
             # Close the websocket
             self.close()
         finally:
             self.ws = None
+            if self._owns_executor:
+                self.executor.shutdown()
             self.dispatcher.close()
 
-            while self.command_events:
-                command_id, result = self.command_events.popitem()
+            with self._command_lock:
+                del self._command_deadlines[:]
+                pending = [
+                    self._pop_command(command_id)
+                    for command_id in list(self.command_events)
+                ]
+            with self._identity_lock:
+                pending.extend(
+                    result for result, _packet, _kwargs in self._identity_queue
+                )
+                del self._identity_queue[:]
+            for result in pending:
                 result.set(None)
 
+            if self.capture is not None:
+                self.capture.close()
+            if self.spool is not None:
+                self.spool.close()
+
     def get_identity(self, timeout=10):
         """
         Get the client's identity.
@@ -195,6 +572,11 @@ class M2MClient:
             )
         return self._identity
 
+    def get_memory_usage(self):
+        """Get the number of items and size of internal structures."""
+        from .memory import get_memory_usage
+        return get_memory_usage(self)
+
     def close(self):
         """A graceful close."""
         # If everything is working, the server will kick us in a few
@@ -204,31 +586,496 @@ class M2MClient:
     def send(self, packet_type, *args, **kwargs):
         """Send a packet."""
         packet = M2MPacket.create(packet_type, *args, **kwargs)
+        self.send_packet(packet)
+
+    def send_packets(self, packets, ws=None):
+        """
+        Send a number of packet objects with as few writes as possible.
+
+        `ws` may be a connection that hasn't replaced the current one
+        yet, in which case the packets are written to it directly.
+
+        """
+        if ws is None:
+            ws = self.ws
+        if not ws.running:
+            for packet in packets:
+                self.send_packet(packet)
+            return
+        packets_bytes = [packet.as_bytes for packet in packets]
+        if self.capture is not None:
+            for packet_bytes in packets_bytes:
+                self.capture.write(capture.OUTBOUND, packet_bytes)
+        if self.outbound is None or ws is not self.ws:
+            ws.send_many(packets_bytes)
+        else:
+            timeout = self._get_outbound_timeout()
+            for packet, packet_bytes in zip(packets, packets_bytes):
+                self.outbound.put(
+                    packet.type,
+                    [packet_bytes],
+                    timeout=timeout
+                )
+        if self.trace.enabled:
+            for packet, packet_bytes in zip(packets, packets_bytes):
+                self.trace.outbound(packet, len(packet_bytes))
+
+    def send_packet(self, packet):
+        """Send a packet object."""
         if self.ws.running:
-            self.ws.send(packet.as_bytes)
-            log.debug(' -> %r', packet)
+            if (self.spool is not None and
+                    self.spool.put_if_pending(packet)):
+                # Sent after the older packets in the spool
+                return
+            buffers = packet.as_buffers
+            if self.outbound is None:
+                self.ws.send_buffers(buffers)
+            else:
+                self.outbound.put(
+                    packet.type,
+                    buffers,
+                    sum(len(buffer) for buffer in buffers),
+                    timeout=self._get_outbound_timeout()
+                )
+            if self.capture is not None:
+                self.capture.write_buffers(capture.OUTBOUND, buffers)
+            if self.trace.enabled:
+                self.trace.outbound(
+                    packet,
+                    sum(len(buffer) for buffer in buffers)
+                )
+        elif self.spool is not None:
+            self.spool.put(packet)
         else:
             log.warning(' -> %r (server gone)', packet)
 
+    def _get_outbound_timeout(self):
+        """
+        Get how long a send may wait for room in the outbound queue.
+
+        The websocket thread never waits, as it must keep receiving.
+
+        """
+        if isinstance(current_thread(), WebSocketThread):
+            return 0
+        return self.outbound_timeout
+
+    def _send_encoded(self, packets, ws=None):
+        """Send a list of (<packet type>, <packet bytes>)."""
+        if ws is None:
+            ws = self.ws
+        if ws is None or not ws.running:
+            raise errors.ConnectionError('server gone')
+        if self.capture is not None:
+            for _packet_type, packet_bytes in packets:
+                self.capture.write(capture.OUTBOUND, packet_bytes)
+        if self.outbound is None or ws is not self.ws:
+            ws.send_many([packet_bytes for _type, packet_bytes in packets])
+        else:
+            for packet_type, packet_bytes in packets:
+                self.outbound.put(packet_type, [packet_bytes])
+
+    def _write(self, buffers):
+        """Write an encoded packet to the websocket, if connected."""
+        ws = self.ws
+        if ws is not None and ws.running:
+            ws.send_buffers(buffers)
+        else:
+            log.warning(
+                ' -> %i bytes (server gone)',
+                sum(len(buffer) for buffer in buffers)
+            )
+
+    def _send_data_packet(self, port, data):
+        """Send a request_send packet."""
+        self.send('request_send', port=port, data=data)
+
+    def _send_control_packet(self, port, data):
+        """Send a request_send_control packet."""
+        self.send('request_send_control', port=port, data=data)
+
+    def _send_data(self, port, data, timeout=None):
+        """Send data to a port, subject to flow control."""
+        if self.flow_control is None:
+            self._send_data_packet(port, data)
+            return
+        if current_thread() is self.ws:
+            # Credit is received on this thread, so it would never come
+            timeout = 0
+        self.flow_control.write(port, data, timeout)
+
+    def send_data(self, port, data, timeout=None):
+        """
+        Send data to a port.
+
+        If `write_delay` is set, small writes are buffered for up to
+        that many seconds and sent in a single packet. If `flow_window`
+        is set, this may block until the peer grants more credit, and
+        raises FlowControlTimeout if there is no credit within `timeout`
+        seconds. A handler called on the websocket thread can't wait for
+        credit, so it gets FlowControlTimeout straight away. If writes
+        are buffered, data that wasn't sent stays queued until there is
+        credit.
+
+        """
+        if self.write_coalescer is None:
+            self._send_data(port, data, timeout)
+        else:
+            self.write_coalescer.write(port, data, timeout)
+
+    def flush_data(self, port=None):
+        """Send data buffered for a port (or all ports) immediately."""
+        if self.write_coalescer is not None:
+            self.write_coalescer.flush(port)
+
+    def decode_packet(self, packet_bytes):
+        """
+        Decode a packet received from the server.
+
+        Packets without a handler are decoded as a PacketView, which
+        decodes attributes only when they are accessed, as most are
+        logged and dropped (or only need the port for routing).
+
+        """
+        try:
+            packet_type = int(packet_bytes[2:packet_bytes.index(b'e', 2)])
+        except ValueError:
+            # Badly formatted, which from_bytes will report
+            packet_type = None
+        if (packet_type is None or
+                self.dispatcher.has_handler(packet_type)):
+            return M2MPacket.from_bytes(packet_bytes)
+        return M2MPacket.view(packet_bytes)
+
+    def dispatch_packet(self, packet):
+        """
+        Dispatch an incoming packet.
+
+        Packets are handled by the executor, except for those in the
+        fast lane which are always handled immediately (as are route
+        control packets, if flow control is enabled). Route data for
+        ports accepted by the `route_sink` goes to the sink rather than
+        a handler.
+
+        A route packet may be a RouteView (if `route_views` is set),
+        which is copied if it will be handled on another thread.
+
+        """
+        if (isinstance(packet, RouteView) and
+                not isinstance(self.executor, InlineExecutor)):
+            packet = packet.retain()
+        if (self.route_sink is not None and
+                packet.type == PacketType.route and
+                self.route_sink.accepts(packet.port)):
+            size = len(packet.data)
+            if (self.flow_control is not None and
+                    not self.flow_control.received(packet.port, size)):
+                return
+            if not self.route_sink.write(packet.port, packet.data):
+                log.debug('route sink full, dropped data for port %i',
+                          packet.port)
+            if self.flow_control is not None:
+                # The sink has the data (or dropped it), so grant credit
+                self.flow_control.consumed(packet.port, size)
+        elif (self.flow_control is not None and
+                packet.type == PacketType.route):
+            if self.flow_control.received(packet.port, len(packet.data)):
+                self.executor.submit(packet, self._dispatch_route)
+        elif (self.flow_control is not None and
+                packet.type == PacketType.route_control):
+            # Credit is applied immediately, as a handler on the
+            # executor may be waiting for it
+            self.dispatcher.dispatch_packet(packet)
+        elif packet.type in FAST_LANE_PACKETS:
+            self.dispatcher.dispatch_packet(packet)
+        else:
+            self.executor.submit(packet, self.dispatcher.dispatch_packet)
+
+    def _dispatch_route(self, packet):
+        """Dispatch a route packet, and grant credit once it's handled."""
+        try:
+            self.dispatcher.dispatch_packet(packet)
+        finally:
+            self.flow_control.consumed(packet.port, len(packet.data))
+
     def command(self, command_packet, *args, **kwargs):
         """
         Send a command to the server.
 
         Return a CommandResult object that may be waited on.
+
+        If `coalesce_commands` is enabled, an idempotent command that is
+        identical to one already in flight will return the pending
+        CommandResult rather than sending another packet.
+
+        If `max_pending_commands` is set, this will block while that
+        many commands are awaiting a response, and raise TooManyCommands
+        if no command completes or expires within `command_timeout`.
+
         """
-        command_id = self.command_id = self.command_id + 1
-        result = self.command_events[command_id] = CommandResult(command_packet)
-        self.send(command_packet, command_id, *args, **kwargs)
+        return self._send_command(command_packet, args, kwargs)
+
+    def prepare(self, command_packet, **fixed):
+        """
+        Prepare a command that will be sent repeatedly.
+
+        Parameters that are the same for each call are given here, and
+        encoded just once. Returns a PreparedCommand, which is called
+        with the remaining parameters to send the command.
+
+        """
+        template = M2MPacket.prepare(command_packet, **fixed)
+        return PreparedCommand(self, command_packet, template)
+
+    def _send_command(self, command_packet, args, kwargs, result=None,
+                      template=None):
+        """Send a command, return a (new or coalesced) CommandResult."""
+        self.sweep_commands()
+        coalesce_key = None
+        with self._command_lock:
+            command_id = self.command_id = self.command_id + 1
+            if template is None:
+                packet = M2MPacket.create(
+                    command_packet, command_id, *args, **kwargs
+                )
+            else:
+                packet = template.create(command_id, *args, **kwargs)
+            if (self.coalesce_commands and result is None and
+                    packet.type in self.IDEMPOTENT_COMMANDS):
+                coalesce_key = self._get_coalesce_key(packet)
+                coalesced = self._coalesced.get(coalesce_key)
+                if coalesced is not None:
+                    log.debug('%r coalesced with %r', packet, coalesced)
+                    return coalesced
+
+        if self.spool is not None and not self.ws.running:
+            # Commands aren't spooled, as the command id would refer to
+            # another command in a later session
+            if result is None:
+                result = CommandResult(command_packet)
+            result.set({'status': 'fail', 'msg': 'not connected'})
+            return result
+
+        self._acquire_command_slot()
+        with self._command_lock:
+            if coalesce_key is not None:
+                # An identical command may have been sent while we were
+                # waiting for a slot
+                coalesced = self._coalesced.get(coalesce_key)
+                if coalesced is not None:
+                    self._command_slots.release()
+                    return coalesced
+            if result is None:
+                result = CommandResult(command_packet)
+            result.sent_time = time.monotonic()
+            result.deadline = result.sent_time + self.command_timeout
+            if self.adaptive_timeout:
+                result.timeout = self.command_rtt.timeout
+            if (self.hedge_commands and result.hedge is None and
+                    packet.type in self.IDEMPOTENT_COMMANDS):
+                result.hedge = self._make_hedge(
+                    command_packet, args, kwargs, template, result
+                )
+            self.command_events[command_id] = result
+            heapq.heappush(
+                self._command_deadlines, (result.deadline, command_id)
+            )
+            if coalesce_key is not None:
+                result.coalesce_key = coalesce_key
+                self._coalesced[coalesce_key] = result
+        self.send_packet(packet)
         return result
 
-    def on_startup(self):
-        """Called on startup."""
-        self.send('request_join')
-        self.send(
+    def _make_hedge(self, command_packet, args, kwargs, template, result):
+        """Make a callable that sends a command again."""
+        client_ref = weakref.ref(self)
+        result_ref = weakref.ref(result)
+
+        def hedge():
+            client = client_ref()
+            result = result_ref()
+            if client is not None and result is not None:
+                client._send_command(
+                    command_packet,
+                    args,
+                    kwargs,
+                    result=result,
+                    template=template
+                )
+        return hedge
+
+    def _acquire_command_slot(self):
+        """Wait for the number of pending commands to drop below the max."""
+        command_slots = self._command_slots
+        if command_slots is None:
+            return
+        give_up = time.monotonic() + self.command_timeout
+        while True:
+            now = time.monotonic()
+            if now >= give_up:
+                if command_slots.acquire(blocking=False):
+                    return
+                raise errors.TooManyCommands(
+                    'too many commands awaiting a response'
+                )
+            # Wake up in time to expire the next stale command
+            wait = give_up - now
+            with self._command_lock:
+                if self._command_deadlines:
+                    wait = min(wait, self._command_deadlines[0][0] - now)
+            if command_slots.acquire(timeout=max(0, wait)):
+                return
+            self.sweep_commands()
+
+    def _pop_command(self, command_id):
+        """
+        Remove a pending command, and return its CommandResult (or None).
+
+        Should be called with the command lock held.
+
+        """
+        command_result = self.command_events.pop(command_id, None)
+        if command_result is not None:
+            coalesce_key = command_result.coalesce_key
+            # A hedged command is popped once for each copy, and a newer
+            # command may have the same key by the second time
+            if (coalesce_key is not None and
+                    self._coalesced.get(coalesce_key) is command_result):
+                del self._coalesced[coalesce_key]
+            if self._command_slots is not None:
+                self._command_slots.release()
+        return command_result
+
+    def _compact_deadlines(self):
+        """
+        Drop deadlines for commands that have completed.
+
+        Completed commands are left in the heap until there are more of
+        them than pending commands. Should be called with the command
+        lock held.
+
+        """
+        deadlines = self._command_deadlines
+        if len(deadlines) > 2 * len(self.command_events) + 64:
+            command_events = self.command_events
+            deadlines[:] = [
+                entry for entry in deadlines if entry[1] in command_events
+            ]
+            heapq.heapify(deadlines)
+
+    def sweep_commands(self, now=None):
+        """
+        Expire commands that have passed their deadline.
+
+        Called when commands are sent and responses are received, and
+        from a thread while connected, so commands expire even if there
+        is no traffic. Returns the number of commands that were expired.
+
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self._command_lock:
+            deadlines = self._command_deadlines
+            while deadlines and deadlines[0][0] <= now:
+                _deadline, command_id = heapq.heappop(deadlines)
+                command_result = self._pop_command(command_id)
+                if command_result is not None:
+                    expired.append(command_result)
+            self.expired_commands += len(expired)
+        for command_result in expired:
+            log.debug('%r expired', command_result)
+            command_result.expire()
+        return len(expired)
+
+    @classmethod
+    def _get_coalesce_key(cls, packet):
+        """Get a key that identifies a command, ignoring the command_id."""
+        return bencode.encode(
+            [int(packet.type)] +
+            [
+                getattr(packet, name)
+                for name, _type in packet.attributes
+                if name != 'command_id'
+            ]
+        )
+
+    def requester_command(self, command_packet, **kwargs):
+        """
+        Send a command with our identity as the `requester` parameter.
+
+        Normally this blocks until the server has sent our identity.
+        With `eager_connect` the command is queued, and sent as soon as
+        the identity arrives.
+
+        """
+        if self.eager_connect:
+            with self._identity_lock:
+                if self._identity is None or self._identity_draining:
+                    # Queued behind earlier commands, so they are sent
+                    # in order
+                    result = CommandResult(command_packet)
+                    self._identity_queue.append(
+                        (result, command_packet, kwargs)
+                    )
+                    return result
+        identity = self.get_identity()
+        return self.command(command_packet, requester=identity, **kwargs)
+
+    def _send_identity_queue(self, queue):
+        """Send commands that were waiting for our identity, in order."""
+        while queue:
+            for result, command_packet, kwargs in queue:
+                kwargs['requester'] = self._identity
+                try:
+                    self._send_command(
+                        command_packet, (), kwargs, result=result
+                    )
+                except Exception:
+                    log.exception('failed to send queued %r', result)
+                    result.set(None)
+            with self._identity_lock:
+                # Commands queued while we were sending
+                queue = self._identity_queue
+                self._identity_queue = []
+                if not queue:
+                    self._identity_draining = False
+
+    def on_startup(self, ws=None):
+        """Called on startup, with the connection that started."""
+        # Encode both before sending, so they go out back to back
+        if self._identity is None:
+            join = M2MPacket.create('request_join')
+        else:
+            # Resume the session after a failover
+            join = M2MPacket.create('request_identify', uuid=self._identity)
+        login = M2MPacket.create(
             'request_login',
             username=self.username,
             password=self.password
         )
+        session_event = self._session_event = Event()
+        self.send_packets([join, login], ws)
+        if self.spool is not None and self.spool.used:
+            # Flushing may take a while if it is rate limited
+            Thread(
+                target=self._flush_spool,
+                args=(ws, session_event),
+                name='m2m-spool',
+                daemon=True
+            ).start()
+
+    def _flush_spool(self, ws, session_event):
+        """Send packets spooled while disconnected."""
+        # Spooled packets from another session are discarded when the
+        # identity is set, so wait for that before sending any
+        if not session_event.wait(self.connect_wait):
+            log.warning('no identity from server, spool not flushed')
+            return
+        try:
+            self.spool.flush(partial(self._send_encoded, ws=ws))
+        except Exception as error:
+            log.warning('unable to flush spool (%s)', error)
 
     def log(self, text):
         """Broadcast a log message."""
@@ -237,14 +1084,12 @@ class M2MClient:
 
     def add_route(self, node1, node2):
         """Create a single route."""
-        identity = self.get_identity()
-        result = self.command(
+        result = self.requester_command(
             "command_add_route",
             node1=node1,
             port1=-1,
             node2=node2,
             port2=-1,
-            requester=identity,
             forwarded=0
         )
         return result
@@ -268,38 +1113,98 @@ class M2MClient:
 
     def set_meta(self, device_id, key, value):
         """Set meta information associated with a device."""
-        identity = self.get_identity()
-        result = self.command("command_set_meta",
-                              requester=identity,
-                              node=device_id,
-                              key=key,
-                              value=value)
+        result = self.requester_command("command_set_meta",
+                                        node=device_id,
+                                        key=key,
+                                        value=value)
         return result
 
     def get_meta(self, device_id):
         """Get a meta dictionary associated with the device."""
-        identity = self.get_identity()
-        result = self.command("command_get_meta",
-                              requester=identity,
-                              node=device_id)
+        result = self.requester_command("command_get_meta",
+                                        node=device_id)
         return result
 
     @expose(PacketType.response)
     def on_command(self, command_id, result):
         """Handle a response to a command."""
-        try:
-            command_result = self.command_events.pop(command_id)
-        except KeyError:
-            log.error('received a response to an unknown event')
-            command_result.set(None)
-        else:
+        with self._command_lock:
+            command_result = self._pop_command(command_id)
+            if command_result is not None:
+                self._compact_deadlines()
+            is_late = (
+                command_result is None and
+                0 < command_id <= self.command_id
+            )
+            if is_late:
+                self.late_responses += 1
+        if command_result is not None:
+            if (command_result.response_time is None and
+                    not command_result.hedged):
+                # Hedged commands are ambiguous, as we don't know which
+                # one the response is for
+                self.command_rtt.update(
+                    time.monotonic() - command_result.sent_time
+                )
             command_result.set(result)
+        elif is_late:
+            log.debug('late response to command %i', command_id)
+        else:
+            log.error('received a response to an unknown event')
+        self.sweep_commands()
 
     @expose(PacketType.set_identity)
     def handle_set_identitiy(self, identity):
         """The server is informing us of our identity on the network."""
-        self._identity = identity
+        with self._identity_lock:
+            self._identity = identity
+            queue = None
+            if self._identity_queue and not self._identity_draining:
+                # Until the queue is sent, new commands go on the queue
+                self._identity_draining = True
+                queue = self._identity_queue
+                self._identity_queue = []
+        if self.spool is not None:
+            self.spool.set_session(identity)
+        self._session_event.set()
         self.identity_event.set()
+        if queue:
+            # Sending commands may block, which mustn't happen on the
+            # websocket thread
+            Thread(
+                target=self._send_identity_queue,
+                args=(queue,),
+                name='m2m-identity-queue',
+                daemon=True
+            ).start()
+
+    @expose(PacketType.instruction)
+    def handle_instruction(self, sender, data):
+        """An instruction from another node."""
+        if not self.instructions.dispatch(sender, data):
+            log.debug('no subscriptions for instruction from %r', sender)
+
+    @expose(PacketType.pong)
+    def handle_pong(self, data):
+        """Response to a ping."""
+        if self.health is not None:
+            self.health.on_pong(data)
+
+    @expose(PacketType.route_control)
+    def handle_route_control(self, port, data):
+        """Out of band data for a port."""
+        if self.flow_control is not None:
+            self.flow_control.on_control(port, data)
+            if self.write_coalescer is not None:
+                self.write_coalescer.resume(port)
+
+    @expose(PacketType.notify_close)
+    def handle_notify_close(self, port):
+        """A port was closed."""
+        if self.flow_control is not None:
+            self.flow_control.close_port(port)
+        if self.write_coalescer is not None:
+            self.write_coalescer.discard(port)
 
     @expose(PacketType.welcome)
     def handle_welcome(self):
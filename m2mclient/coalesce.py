@@ -0,0 +1,240 @@
+"""
+Coalesces small writes to a port.
+
+Interactive traffic (such as a terminal) tends to generate many writes
+of just a few bytes. Rather than send a request_send packet for each,
+the WriteCoalescer buffers writes to a port until `delay` seconds have
+passed since the first write, or `max_bytes` have been buffered, then
+sends them as a single packet.
+
+Data is sent after the lock is released, so a send that blocks (for
+flow control credit) doesn't hold up writes to other ports. Data taken
+from the buffer is queued per port, and sent by one thread at a time,
+so it is always sent in the order it was written.
+
+The timer thread never waits for credit, as that would hold up flushes
+for every other port. Data that can't be sent for lack of credit stays
+queued, and is sent when `resume(port)` is called as credit arrives.
+
+"""
+
+import logging
+import time
+from collections import deque
+from threading import Condition
+from threading import Thread
+
+from . import errors
+
+
+log = logging.getLogger('m2m.coalesce')
+
+
+class WriteCoalescer(object):
+    """
+    Merges writes to a port, and sends them with
+    `send(port, data, timeout)`.
+
+    """
+
+    def __init__(self, send, delay=0.002, max_bytes=16 * 1024):
+        self._send = send
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self._buffers = {}
+        # Insertion ordered, and the delay is fixed, so the first item
+        # is always the next to flush
+        self._deadlines = {}
+        # Data taken from the buffers, waiting to be sent, per port
+        self._outgoing = {}
+        # Ports with a thread sending their outgoing data
+        self._sending = set()
+        # Ports with outgoing data waiting for flow control credit
+        self._blocked = set()
+        # Ports granted credit, for the timer thread to send
+        self._ready = set()
+        self._condition = Condition()
+        self._closed = False
+        self._thread = Thread(
+            target=self._run,
+            name='m2m-coalesce',
+            daemon=True
+        )
+        self._thread.start()
+
+    def __repr__(self):
+        return "WriteCoalescer(delay={!r}, max_bytes={!r})".format(
+            self.delay,
+            self.max_bytes
+        )
+
+    def write(self, port, data, timeout=None):
+        """
+        Buffer data to be sent to a port.
+
+        `timeout` is passed to `send`, if the data is sent by this call.
+        If that raises FlowControlTimeout, the data that wasn't sent
+        stays queued, to be sent when there is credit.
+
+        """
+        with self._condition:
+            if self._closed:
+                raise ValueError('write coalescer is closed')
+            buffer = self._buffers.get(port)
+            if buffer is None:
+                if len(data) >= self.max_bytes:
+                    # No point in buffering
+                    self._queue(port, bytes(data))
+                else:
+                    buffer = self._buffers[port] = bytearray()
+                    self._deadlines[port] = time.monotonic() + self.delay
+                    self._condition.notify()
+            if buffer is not None:
+                buffer += data
+                if len(buffer) < self.max_bytes:
+                    return
+                self._flush_port(port)
+        self._send_outgoing(port, timeout)
+
+    def flush(self, port=None):
+        """
+        Send buffered and queued data for a port, or all ports if port
+        is None.
+
+        """
+        with self._condition:
+            if port is None:
+                ports = set(self._buffers).union(self._outgoing)
+            else:
+                ports = [port]
+            for port in ports:
+                if port in self._buffers:
+                    self._flush_port(port)
+        for port in ports:
+            self._send_outgoing(port)
+
+    def resume(self, port):
+        """Called when the peer grants credit to send to a port."""
+        with self._condition:
+            if port in self._blocked or port in self._sending:
+                self._blocked.discard(port)
+                self._ready.add(port)
+                self._condition.notify()
+
+    def discard(self, port):
+        """Drop data for a port, which was closed."""
+        with self._condition:
+            self._buffers.pop(port, None)
+            self._deadlines.pop(port, None)
+            self._outgoing.pop(port, None)
+            self._blocked.discard(port)
+            self._ready.discard(port)
+
+    def close(self, timeout=None):
+        """
+        Send all buffered data, and stop the coalescer.
+
+        Data that can't be sent within `timeout` seconds is dropped.
+
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        give_up = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            for port in list(self._buffers):
+                self._flush_port(port)
+            ports = list(self._outgoing)
+        for port in ports:
+            if give_up is not None:
+                timeout = max(0, give_up - time.monotonic())
+            try:
+                self._send_outgoing(port, timeout)
+            except Exception as error:
+                log.warning(
+                    'dropped data for port %r on close (%s)',
+                    port,
+                    error
+                )
+
+    def _flush_port(self, port):
+        """Queue buffered data (call with the condition lock held)."""
+        del self._deadlines[port]
+        self._queue(port, bytes(self._buffers.pop(port)))
+
+    def _queue(self, port, data):
+        """Queue data to send (call with the condition lock held)."""
+        self._outgoing.setdefault(port, deque()).append(data)
+
+    def _send_outgoing(self, port, timeout=None):
+        """
+        Send data queued for a port (call without the lock).
+
+        If another thread is already sending for the port, it will send
+        the queued data after its own.
+
+        """
+        condition = self._condition
+        with condition:
+            if port in self._sending:
+                return
+            self._sending.add(port)
+        try:
+            while True:
+                with condition:
+                    outgoing = self._outgoing.get(port)
+                    if not outgoing:
+                        # In the same lock as the check, so a writer
+                        # can't queue data that nothing sends
+                        self._outgoing.pop(port, None)
+                        self._sending.discard(port)
+                        return
+                    data = outgoing.popleft()
+                self._send(port, data, timeout)
+        except errors.FlowControlTimeout as error:
+            with condition:
+                self._sending.discard(port)
+                if error.remaining:
+                    self._outgoing.setdefault(port, deque()).appendleft(
+                        error.remaining
+                    )
+                if port not in self._ready:
+                    # Otherwise credit arrived while sending, and the
+                    # timer thread will try again
+                    self._blocked.add(port)
+            raise
+        except BaseException:
+            with condition:
+                self._sending.discard(port)
+            raise
+
+    def _run(self):
+        """Flush buffers when their delay expires."""
+        condition = self._condition
+        deadlines = self._deadlines
+        while True:
+            with condition:
+                if self._closed:
+                    return
+                if self._ready:
+                    port = self._ready.pop()
+                elif not deadlines:
+                    condition.wait()
+                    continue
+                else:
+                    port, deadline = next(iter(deadlines.items()))
+                    wait = deadline - time.monotonic()
+                    if wait > 0:
+                        condition.wait(wait)
+                        continue
+                    self._flush_port(port)
+            try:
+                # Never wait for credit here
+                self._send_outgoing(port, 0)
+            except errors.FlowControlTimeout:
+                log.debug('port %r is waiting for credit', port)
+            except Exception:
+                log.exception(
+                    'failed to send coalesced data for port %r', port
+                )
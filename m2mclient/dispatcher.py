@@ -36,24 +36,55 @@ class Dispatcher:
         self._packet_handlers = {}
         self._init_dispatcher(instance or self)
 
-    def _init_dispatcher(self, handler_instance):
+    # Maps a handler class on to a dict of packet type -> method name
+    _handler_names_cache = {}
+
+    @classmethod
+    def _get_handler_names(cls, handler_cls):
         """
         Finds the methods decorated with @expose, and creates a dict
-        that maps packet type on to the method.
+        that maps packet type on to the method name.
+
+        The result is cached, so the class is only scanned once.
 
         """
-        for method_name in dir(handler_instance):
-            if method_name.startswith('_'):
-                continue
-            method = getattr(handler_instance, method_name, None)
-            if getattr(method, '_dispatcher_exposed', False):
-                packet_type = method._dispatcher_packet_type
-                self._packet_handlers[packet_type] = method
+        try:
+            return cls._handler_names_cache[handler_cls]
+        except KeyError:
+            pass
+        # Method name -> packet type, ordered from base to derived
+        exposed = {}
+        for base in reversed(handler_cls.__mro__):
+            for method_name, method in vars(base).items():
+                if method_name.startswith('_'):
+                    continue
+                exposed.pop(method_name, None)
+                if getattr(method, '_dispatcher_exposed', False):
+                    exposed[method_name] = method._dispatcher_packet_type
+        # Handlers in derived classes replace those in base classes
+        handler_names = {
+            packet_type: method_name
+            for method_name, packet_type in exposed.items()
+        }
+        cls._handler_names_cache[handler_cls] = handler_names
+        return handler_names
+
+    def _init_dispatcher(self, handler_instance):
+        """Creates a dict that maps packet type on to the method."""
+        handler_names = self._get_handler_names(type(handler_instance))
+        for packet_type, method_name in handler_names.items():
+            self._packet_handlers[packet_type] = getattr(
+                handler_instance, method_name
+            )
 
     def close(self):
         """Close the dispatcher (will be unusable after this call).."""
         self._packet_handlers.clear()
 
+    def has_handler(self, packet_type):
+        """Check if there is a handler for a packet type."""
+        return packet_type in self._packet_handlers
+
     def dispatch(self, packet_type, packet_body):
         """Dispatch a packet to appropriate handler."""
         if not isinstance(packet_type, int):
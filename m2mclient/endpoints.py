@@ -0,0 +1,203 @@
+"""
+Selecting between several M2M servers.
+
+M2MClient accepts a list of urls. Before connecting, every endpoint is
+probed at once: a websocket is opened and the round trip time of an M2M
+ping is measured. The client connects to the fastest endpoint that
+answered, and falls back to the others in order.
+
+If `failover_interval` is set, a HealthMonitor pings the current server
+at that interval. If `failover_misses` pings in a row go unanswered for
+`failover_timeout` seconds, the smoothed round trip time goes over
+`failover_max_rtt`, or the connection drops, the endpoints are probed
+again and the session moves to the fastest of the others, resuming the
+same identity with request_identify.
+
+"""
+
+import logging
+import time
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+from .packets import M2MPacket
+from .packets import PacketType
+from . import errors
+from . import wsframe
+
+
+log = logging.getLogger('m2m.endpoints')
+
+
+def probe(url, timeout=2):
+    """
+    Get the round trip time to an M2M server, in seconds.
+
+    Returns None if the server couldn't be reached, or didn't respond
+    within `timeout` seconds.
+
+    """
+    # Transport imports the client, which imports this module
+    from .transport import open_websocket
+    try:
+        sock, data = open_websocket(url, timeout=timeout)
+    except (OSError, errors.ConnectionError) as error:
+        log.debug('probe to %s failed (%s)', url, error)
+        return None
+    try:
+        sock.settimeout(timeout)
+        ping = M2MPacket.create('ping', data=b'probe')
+        start = time.perf_counter()
+        wsframe.send_vectored(sock, wsframe.build_frame([ping.as_bytes]))
+        buffer = bytearray(data)
+        while True:
+            frame = wsframe.parse_frame(buffer, 0, len(buffer))
+            if frame is None:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return None
+                buffer += chunk
+                continue
+            _fin, opcode, payload, end = frame
+            del buffer[:end]
+            is_pong = (
+                opcode == wsframe.OPCODE_BINARY and
+                M2MPacket.peek_type(payload) == PacketType.pong
+            )
+            if is_pong:
+                return time.perf_counter() - start
+    except (OSError, wsframe.FrameError) as error:
+        log.debug('probe to %s failed (%s)', url, error)
+        return None
+    finally:
+        try:
+            wsframe.send_vectored(
+                sock,
+                wsframe.build_frame([b'\x03\xe8'], wsframe.OPCODE_CLOSE)
+            )
+        except OSError:
+            pass
+        sock.close()
+
+
+def probe_all(urls, timeout=2):
+    """Probe endpoints concurrently, return a dict of url -> RTT."""
+    results = {}
+
+    def do_probe(url):
+        results[url] = probe(url, timeout)
+
+    threads = [
+        Thread(target=do_probe, args=(url,), name='m2m-probe', daemon=True)
+        for url in urls
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout * 2)
+    return {url: results.get(url) for url in urls}
+
+
+def rank_endpoints(urls, timeout=2):
+    """Get the urls that responded to a probe, fastest first."""
+    rtts = probe_all(urls, timeout)
+    log.debug('endpoint probes %r', rtts)
+    return sorted(
+        (url for url, rtt in rtts.items() if rtt is not None),
+        key=rtts.get
+    )
+
+
+class HealthMonitor(object):
+    """Pings the server, and fails over if it degrades."""
+
+    # Weight of a new sample in the smoothed RTT
+    ALPHA = 0.125
+
+    def __init__(self, client, interval=1, timeout=2, misses=3,
+                 max_rtt=None):
+        self.client = client
+        self.interval = interval
+        self.timeout = timeout
+        self.misses = misses
+        self.max_rtt = max_rtt
+        self.rtt = None
+        self.missed = 0
+        self.failovers = 0
+        self._lock = Lock()
+        self._sequence = 0
+        self._ping_time = None
+        self._stop_event = Event()
+        self._thread = Thread(
+            target=self._run,
+            name='m2m-health',
+            daemon=True
+        )
+
+    def __repr__(self):
+        return "<health rtt={} missed={}>".format(self.rtt, self.missed)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.ident is not None:
+            self._thread.join(self.timeout)
+
+    def on_pong(self, data):
+        """Called with the data from a pong packet."""
+        with self._lock:
+            if self._ping_time is None or data != b'%i' % self._sequence:
+                return
+            rtt = time.monotonic() - self._ping_time
+            self._ping_time = None
+            self.missed = 0
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                self.rtt += self.ALPHA * (rtt - self.rtt)
+
+    def is_degraded(self):
+        """Check if the current server has degraded."""
+        ws = self.client.ws
+        if ws is None or not ws.running:
+            return True
+        with self._lock:
+            if self._ping_time is not None:
+                if time.monotonic() - self._ping_time > self.timeout:
+                    self.missed += 1
+                    self._ping_time = None
+            if self.missed >= self.misses:
+                return True
+            return self.max_rtt is not None and \
+                self.rtt is not None and self.rtt > self.max_rtt
+
+    def _run(self):
+        client = self.client
+        while not self._stop_event.wait(self.interval):
+            if self.is_degraded():
+                log.warning(
+                    '%s has degraded (rtt=%s, missed=%i)',
+                    client.url,
+                    self.rtt,
+                    self.missed
+                )
+                with self._lock:
+                    self.rtt = None
+                    self.missed = 0
+                    self._ping_time = None
+                try:
+                    if client.failover():
+                        self.failovers += 1
+                except Exception:
+                    log.exception('failover failed')
+                continue
+            with self._lock:
+                if self._ping_time is not None:
+                    continue
+                self._sequence += 1
+                self._ping_time = time.monotonic()
+                data = b'%i' % self._sequence
+            client.send('ping', data=data)
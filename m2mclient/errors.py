@@ -4,6 +4,17 @@ class ConnectionError(Exception):
     """Unable to connect to M2M server."""
 
 
+class FlowControlTimeout(Exception):
+    """The peer didn't grant credit to send more data in time."""
+
+    # The data that wasn't sent
+    remaining = b''
+
+
+class OutboundFull(Exception):
+    """Too much data was queued to send, for too long."""
+
+
 class CommandError(Exception):
     """M2M command error base exception."""
 
@@ -20,5 +31,9 @@ class CommandFail(CommandError):
     """The M2M servers responded with an explicit error to a command."""
 
 
+class TooManyCommands(CommandError):
+    """Too many commands are waiting for a response from the server."""
+
+
 class NoIdentity(CommandError):
     """The server didn't send us the identity in time."""
@@ -0,0 +1,126 @@
+"""
+Executors that run packet handlers.
+
+By default handlers are called inline, on the websocket thread. An
+OrderedExecutor runs handlers on a pool of worker threads, so that a
+slow handler won't hold up other traffic. Packets with the same key
+(the port or the packet type) always go to the same worker, and are
+handled in the order they were received.
+
+Each worker's queue holds up to `max_queued` packets. When a queue is
+full, the websocket thread waits for room, so the server stops sending
+rather than memory growing without limit. A handler that waits for a
+command response while its queue is full is stuck until the command
+expires, so keep `max_queued` generous if handlers send commands.
+
+Packets in FAST_LANE_PACKETS are always handled on the websocket thread,
+so command responses are never stuck behind a slow handler, and a failed
+login (which raises M2MAuthFailed) stops the connection.
+
+"""
+
+import logging
+from queue import Queue
+from threading import Thread
+from threading import current_thread
+
+from .packets import PacketType
+
+
+log = logging.getLogger('m2m.executors')
+
+FAST_LANE_PACKETS = frozenset([
+    PacketType.response,
+    PacketType.ping,
+    PacketType.pong,
+    PacketType.keep_alive,
+    PacketType.set_identity,
+    PacketType.notify_login_fail,
+])
+
+
+class InlineExecutor(object):
+    """Calls handlers immediately, on the calling thread."""
+
+    def submit(self, packet, handler):
+        """Handle a packet."""
+        return handler(packet)
+
+    def shutdown(self, wait=True):
+        """Nothing to shut down."""
+
+
+class OrderedExecutor(object):
+    """
+    Runs handlers on worker threads, preserving the order of packets
+    for each port (if `order_by` is 'port') or packet type (if `order_by`
+    is 'type').
+
+    """
+
+    def __init__(self, workers=4, order_by='port', name='m2m-dispatch',
+                 max_queued=1024):
+        if order_by not in ('port', 'type'):
+            raise ValueError("order_by should be 'port' or 'type'")
+        self.order_by = order_by
+        self.max_queued = max_queued
+        self._queues = [Queue(max_queued) for _ in range(workers)]
+        self._threads = [
+            Thread(
+                target=self._run,
+                args=(queue,),
+                name='{}-{}'.format(name, index),
+                daemon=True
+            )
+            for index, queue in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __repr__(self):
+        return "OrderedExecutor(workers={}, order_by={!r})".format(
+            len(self._queues),
+            self.order_by
+        )
+
+    def get_key(self, packet):
+        """Get the key that determines which worker handles a packet."""
+        if self.order_by == 'port':
+            port = getattr(packet, 'port', None)
+            if port is not None:
+                return port
+        return int(packet.type)
+
+    def submit(self, packet, handler):
+        """
+        Queue a packet to be handled by a worker.
+
+        Blocks while the worker's queue is full.
+
+        """
+        queues = self._queues
+        queues[hash(self.get_key(packet)) % len(queues)].put(
+            (packet, handler)
+        )
+
+    def shutdown(self, wait=True):
+        """Stop the workers, after they handle queued packets."""
+        for queue in self._queues:
+            queue.put(None)
+        if wait:
+            for thread in self._threads:
+                if thread is not current_thread():
+                    thread.join()
+
+    def _run(self, queue):
+        """Worker thread loop."""
+        get = queue.get
+        while True:
+            item = get()
+            if item is None:
+                break
+            packet, handler = item
+            try:
+                handler(packet)
+            except Exception:
+                log.exception('error handling %r', packet)
@@ -0,0 +1,293 @@
+"""
+A fleet of M2M clients running in worker processes.
+
+Each worker process has its own M2MClient (and connection), so decoding
+and handling packets is spread over multiple cores rather than sharing a
+single GIL. Requests are sent to a worker chosen by a shard key (such as
+a port or device id), so work for a given key always goes to the same
+worker.
+
+    with ClientFleet(url, username, password, workers=4) as fleet:
+        meta = fleet.call(device_id, 'get_meta', device_id)
+        print(fleet.get_stats())
+
+To handle packets (e.g. route data) in the workers, pass a subclass of
+M2MClient with exposed handlers as `client_class`. It must be importable
+by the worker processes.
+
+"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+import zlib
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from threading import Thread
+
+from .client import CommandResult
+from .client import M2MClient
+from . import errors
+
+
+log = logging.getLogger('m2m.fleet')
+
+
+def get_client_stats(client):
+    """Get a dict of counters from a client."""
+    return {
+        'commands': client.command_id,
+        'pending_commands': len(client.command_events),
+        'expired_commands': client.expired_commands,
+        'late_responses': client.late_responses,
+    }
+
+
+def _picklable_error(error):
+    """Make sure an exception may be sent to another process."""
+    try:
+        pickle.dumps(error)
+    except Exception:
+        return RuntimeError(repr(error))
+    return error
+
+
+def _run_worker(conn, client_class, client_args, client_kwargs, threads):
+    """Entry point for a worker process."""
+    try:
+        client = client_class(*client_args, **client_kwargs)
+        client.__enter__()
+    except Exception as error:
+        conn.send((None, False, _picklable_error(error)))
+        return
+    conn.send((None, True, os.getpid()))
+
+    send_lock = Lock()
+
+    def reply(request_id, ok, value):
+        with send_lock:
+            try:
+                conn.send((request_id, ok, value))
+            except Exception as error:
+                conn.send((request_id, False, _picklable_error(error)))
+
+    def handle(request_id, action, method_name, args, kwargs):
+        try:
+            if action == 'stats':
+                result = get_client_stats(client)
+            else:
+                result = getattr(client, method_name)(*args, **kwargs)
+                if isinstance(result, CommandResult):
+                    result = result.get()
+        except Exception as error:
+            reply(request_id, False, _picklable_error(error))
+        else:
+            reply(request_id, True, result)
+
+    try:
+        with ThreadPoolExecutor(threads) as pool:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                if request is None:
+                    break
+                pool.submit(handle, *request)
+    finally:
+        client.__exit__(None, None, None)
+        conn.close()
+
+
+class _Worker(object):
+    """The supervisor's handle to a worker process."""
+
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.request_id = 0
+        self.pending = {}
+        self.lock = Lock()
+        self.reader = Thread(
+            target=self._read,
+            name='m2m-fleet-{}'.format(index),
+            daemon=True
+        )
+
+    def submit(self, action, method_name, args, kwargs):
+        """Send a request to the worker, return a Future."""
+        future = Future()
+        with self.lock:
+            self.request_id += 1
+            request_id = self.request_id
+            self.pending[request_id] = future
+            self.conn.send(
+                (request_id, action, method_name, args, kwargs)
+            )
+        return future
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                pass
+
+    def _read(self):
+        """Resolve futures as responses arrive."""
+        try:
+            while True:
+                request_id, ok, value = self.conn.recv()
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                pending = list(self.pending.values())
+                self.pending.clear()
+            for future in pending:
+                future.set_exception(
+                    errors.ConnectionError('fleet worker exited')
+                )
+
+
+class ClientFleet(object):
+    """Supervises a number of M2MClient worker processes."""
+
+    def __init__(self, url, username, password, workers=None,
+                 client_class=M2MClient, threads=8, start_timeout=30,
+                 **client_kwargs):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.worker_count = workers or os.cpu_count() or 1
+        self.client_class = client_class
+        self.threads = threads
+        self.start_timeout = start_timeout
+        self.client_kwargs = client_kwargs
+        self.workers = []
+
+    def __repr__(self):
+        return "ClientFleet({!r}, workers={})".format(
+            self.url,
+            self.worker_count
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        """Start the worker processes, and wait for them to connect."""
+        context = multiprocessing.get_context()
+        try:
+            for index in range(self.worker_count):
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(
+                    target=_run_worker,
+                    args=(
+                        child_conn,
+                        self.client_class,
+                        (self.url, self.username, self.password),
+                        self.client_kwargs,
+                        self.threads
+                    ),
+                    name='m2m-fleet-{}'.format(index),
+                    daemon=True
+                )
+                process.start()
+                child_conn.close()
+                self.workers.append(_Worker(index, process, parent_conn))
+
+            for worker in self.workers:
+                if not worker.conn.poll(self.start_timeout):
+                    raise errors.ConnectionError(
+                        'fleet worker {} failed to start'.format(worker.index)
+                    )
+                _request_id, ok, value = worker.conn.recv()
+                if not ok:
+                    raise errors.ConnectionError(
+                        'fleet worker {} failed to connect ({})'.format(
+                            worker.index, value
+                        )
+                    )
+                worker.reader.start()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self, timeout=10):
+        """Disconnect the workers, and wait for them to exit."""
+        for worker in self.workers:
+            worker.close()
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                log.warning('terminating %s', worker.process.name)
+                worker.process.terminate()
+        del self.workers[:]
+
+    def get_worker_index(self, shard_key):
+        """Get the index of the worker for a given shard key."""
+        # Must be consistent across processes, so don't use hash()
+        key_bytes = repr(shard_key).encode('utf-8')
+        return zlib.crc32(key_bytes) % self.worker_count
+
+    def submit(self, shard_key, method_name, *args, **kwargs):
+        """
+        Call a method of the client in the worker for `shard_key`.
+
+        Returns a Future. If the method returns a CommandResult, the
+        future will resolve to the command's result.
+
+        """
+        worker = self.workers[self.get_worker_index(shard_key)]
+        return worker.submit('call', method_name, args, kwargs)
+
+    def call(self, shard_key, method_name, *args, **kwargs):
+        """Call a method of the client in a worker, and wait for the result."""
+        return self.submit(shard_key, method_name, *args, **kwargs).result()
+
+    def command(self, shard_key, command_packet, *args, **kwargs):
+        """Send a command from the worker for `shard_key`, return a Future."""
+        return self.submit(
+            shard_key, 'command', command_packet, *args, **kwargs
+        )
+
+    def broadcast(self, method_name, *args, **kwargs):
+        """Call a method of the client in every worker, return results."""
+        futures = [
+            worker.submit('call', method_name, args, kwargs)
+            for worker in self.workers
+        ]
+        return [future.result() for future in futures]
+
+    def get_worker_stats(self):
+        """Get a list of counters for each worker."""
+        futures = [
+            worker.submit('stats', None, (), {})
+            for worker in self.workers
+        ]
+        return [future.result() for future in futures]
+
+    def get_stats(self):
+        """Get counters summed over all workers."""
+        totals = {}
+        for stats in self.get_worker_stats():
+            for name, value in stats.items():
+                totals[name] = totals.get(name, 0) + value
+        totals['workers'] = len(self.workers)
+        return totals
@@ -0,0 +1,178 @@
+"""
+Credit based flow control for channels.
+
+Each side of a channel may have at most `window` bytes of route data
+that the other side hasn't consumed yet. Both sides start with a credit
+of `window` bytes for every port. Sending data uses up credit, and a
+writer blocks when there is none left. When the receiver has consumed
+data it grants the credit back, with a route control packet containing:
+
+    {"credit": <number of bytes>}
+
+Credit is granted in batches of at least half the window, so there are
+few control packets. Buffered data per port is bounded by the window,
+so memory use stays predictable however many ports are open.
+
+Both ends of a channel must use flow control with the same window.
+
+"""
+
+import logging
+import time
+from threading import Condition
+
+from . import bencode
+from . import errors
+
+
+log = logging.getLogger('m2m.flowcontrol')
+
+
+class FlowControl(object):
+    """
+    Tracks credit for ports.
+
+    `send_data(port, data)` sends route data, and
+    `send_control(port, data)` sends an out of band control packet.
+
+    """
+
+    def __init__(self, send_data, send_control, window=256 * 1024):
+        self._send_data = send_data
+        self._send_control = send_control
+        self.window = window
+        self._condition = Condition()
+        # Bytes we may send to each port
+        self._send_credit = {}
+        # Bytes received and not yet consumed, per port
+        self._buffered = {}
+        # Bytes consumed but not yet granted back to the sender
+        self._consumed = {}
+        # Number of writers waiting for credit, per port
+        self._waiting = {}
+        # Ports closed while writers were waiting
+        self._closed_ports = set()
+        # Times the peer sent more than the window
+        self.violations = 0
+
+    def __repr__(self):
+        return "FlowControl(window={})".format(self.window)
+
+    def write(self, port, data, timeout=None):
+        """
+        Send data to a port, blocking while there is no credit.
+
+        Raises FlowControlTimeout if there isn't enough credit within
+        `timeout` seconds, with the data that wasn't sent in its
+        `remaining` attribute.
+
+        """
+        data = memoryview(data)
+        give_up = None if timeout is None else time.monotonic() + timeout
+        condition = self._condition
+        while data:
+            with condition:
+                credit = self._send_credit.setdefault(port, self.window)
+                if credit <= 0:
+                    try:
+                        credit = self._wait_for_credit(port, give_up)
+                    except errors.FlowControlTimeout as error:
+                        error.remaining = data.tobytes()
+                        raise
+                chunk_size = min(credit, len(data))
+                self._send_credit[port] = credit - chunk_size
+            self._send_data(port, data[:chunk_size].tobytes())
+            data = data[chunk_size:]
+
+    def _wait_for_credit(self, port, give_up):
+        """Wait for the peer to grant credit (call with the lock held)."""
+        condition = self._condition
+        self._waiting[port] = self._waiting.get(port, 0) + 1
+        try:
+            while True:
+                if port in self._closed_ports:
+                    raise errors.ConnectionError(
+                        'port {} is closed'.format(port)
+                    )
+                credit = self._send_credit[port]
+                if credit > 0:
+                    return credit
+                wait = None
+                if give_up is not None:
+                    wait = give_up - time.monotonic()
+                    if wait <= 0:
+                        raise errors.FlowControlTimeout(
+                            'no credit to send to port {}'.format(port)
+                        )
+                condition.wait(wait)
+        finally:
+            self._waiting[port] -= 1
+            if not self._waiting[port]:
+                del self._waiting[port]
+                self._closed_ports.discard(port)
+
+    def received(self, port, size):
+        """
+        Record data received for a port.
+
+        Returns False if the peer has exceeded the window, in which
+        case the data should be discarded.
+
+        """
+        with self._condition:
+            buffered = self._buffered.get(port, 0) + size
+            if buffered > self.window:
+                self.violations += 1
+                log.warning(
+                    'port %r exceeded flow control window (%i bytes)',
+                    port,
+                    buffered
+                )
+                return False
+            self._buffered[port] = buffered
+        return True
+
+    def consumed(self, port, size):
+        """Record data that was consumed, granting credit if required."""
+        with self._condition:
+            if port not in self._buffered:
+                # Port was closed
+                return
+            self._buffered[port] = max(0, self._buffered.get(port, 0) - size)
+            consumed = self._consumed.get(port, 0) + size
+            if consumed < self.window // 2:
+                self._consumed[port] = consumed
+                return
+            self._consumed[port] = 0
+        self._send_control(port, bencode.encode({'credit': consumed}))
+
+    def on_control(self, port, data):
+        """Handle a route control packet from the peer."""
+        try:
+            control = bencode.decode(data)
+        except bencode.DecodeError:
+            return
+        if not isinstance(control, dict):
+            return
+        credit = control.get('credit')
+        if isinstance(credit, int) and credit > 0:
+            with self._condition:
+                self._send_credit[port] = (
+                    self._send_credit.get(port, self.window) + credit
+                )
+                self._condition.notify_all()
+
+    def close_port(self, port):
+        """Forget a port, and wake up anything writing to it."""
+        with self._condition:
+            self._send_credit.pop(port, None)
+            self._buffered.pop(port, None)
+            self._consumed.pop(port, None)
+            if port in self._waiting:
+                self._closed_ports.add(port)
+            self._condition.notify_all()
+
+    def get_buffered(self, port):
+        """Get the number of unconsumed bytes received for a port."""
+        with self._condition:
+            return self._buffered.get(port, 0)
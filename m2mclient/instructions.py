@@ -0,0 +1,182 @@
+"""
+Subscriptions to instruction packets.
+
+Instructions are a sender identity and a dict of data. Callbacks may
+subscribe to instructions from a particular sender, or with particular
+values in the data, or both:
+
+    client.instructions.subscribe(on_reboot, action='reboot')
+    client.instructions.subscribe(on_any, sender=device_uuid)
+    client.instructions.subscribe(on_config, config=ANY)
+
+Each subscription is indexed by its sender (or None for any sender) and
+one of its key / value conditions, so matching an instruction is a few
+dict lookups per key in the data, however many subscriptions there are.
+Any further conditions are checked only for subscriptions found in the
+index.
+
+"""
+
+import logging
+from itertools import count
+from threading import Lock
+
+
+log = logging.getLogger('m2m.instructions')
+
+
+class _Any(object):
+    """Matches any value, if the key is present."""
+
+    def __repr__(self):
+        return 'ANY'
+
+
+ANY = _Any()
+
+
+class Subscription(object):
+    """A callback for instructions that match some conditions."""
+
+    def __init__(self, registry, subscription_id, callback, sender, match):
+        self.registry = registry
+        self.id = subscription_id
+        self.callback = callback
+        self.sender = sender
+        self.match = match
+        # The condition used in the index, and those checked afterwards
+        self.index_key = None
+        self.conditions = ()
+
+    def __repr__(self):
+        return "<subscription #{} sender={!r} match={!r}>".format(
+            self.id,
+            self.sender,
+            self.match
+        )
+
+    def cancel(self):
+        """Stop receiving instructions."""
+        self.registry.unsubscribe(self)
+
+    def check(self, data):
+        """Check the conditions that aren't covered by the index."""
+        for key, value in self.conditions:
+            if key not in data:
+                return False
+            if value is not ANY and data[key] != value:
+                return False
+        return True
+
+
+class InstructionRegistry(object):
+    """Calls subscribed callbacks with matching instructions."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._ids = count(1)
+        # sender -> {id: subscription}, for subscriptions with no data
+        # conditions
+        self._by_sender = {}
+        # (sender, key, value) -> {id: subscription}
+        self._by_value = {}
+        self._count = 0
+
+    def __repr__(self):
+        return "<instructions {} subscriptions>".format(len(self))
+
+    def __len__(self):
+        return self._count
+
+    def subscribe(self, callback, sender=None, **match):
+        """
+        Call `callback(sender, data)` for matching instructions.
+
+        If `sender` is given, only instructions from that identity
+        match. Keyword arguments are values that must be in the data
+        (use ANY to match if the key is present). Returns a
+        Subscription.
+
+        """
+        if isinstance(sender, str):
+            sender = sender.encode()
+        subscription = Subscription(
+            self, next(self._ids), callback, sender, match
+        )
+        conditions = list(match.items())
+        # Prefer a specific value in the index, as it matches less
+        conditions.sort(key=lambda condition: condition[1] is ANY)
+        with self._lock:
+            if conditions:
+                key, value = conditions[0]
+                index_key = (sender, key, value)
+                self._by_value.setdefault(index_key, {})[
+                    subscription.id
+                ] = subscription
+                subscription.index_key = index_key
+                subscription.conditions = tuple(conditions[1:])
+            else:
+                self._by_sender.setdefault(sender, {})[
+                    subscription.id
+                ] = subscription
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription."""
+        with self._lock:
+            if subscription.index_key is None:
+                index, index_key = self._by_sender, subscription.sender
+            else:
+                index, index_key = self._by_value, subscription.index_key
+            subscriptions = index.get(index_key)
+            if not subscriptions or subscription.id not in subscriptions:
+                return
+            del subscriptions[subscription.id]
+            if not subscriptions:
+                del index[index_key]
+            self._count -= 1
+
+    def get_matches(self, sender, data):
+        """Get the subscriptions that match an instruction, in order."""
+        by_value = self._by_value
+        with self._lock:
+            matches = []
+            for index_sender in (sender, None):
+                subscriptions = self._by_sender.get(index_sender)
+                if subscriptions:
+                    matches.extend(subscriptions.values())
+            if by_value and isinstance(data, dict):
+                for key, value in data.items():
+                    try:
+                        hash(value)
+                    except TypeError:
+                        # Lists and dicts can only match ANY
+                        values = (ANY,)
+                    else:
+                        values = (value, ANY)
+                    for index_sender in (sender, None):
+                        for index_value in values:
+                            subscriptions = by_value.get(
+                                (index_sender, key, index_value)
+                            )
+                            if subscriptions:
+                                matches.extend(
+                                    subscription
+                                    for subscription in subscriptions.values()
+                                    if subscription.check(data)
+                                )
+        if len(matches) > 1:
+            matches.sort(key=lambda subscription: subscription.id)
+        return matches
+
+    def dispatch(self, sender, data):
+        """Call matching callbacks, return the number called."""
+        matches = self.get_matches(sender, data)
+        for subscription in matches:
+            try:
+                subscription.callback(sender, data)
+            except Exception:
+                log.exception('error in instruction callback %r',
+                              subscription)
+        return len(matches)
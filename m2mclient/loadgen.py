@@ -0,0 +1,519 @@
+"""
+Synthetic load for capacity planning M2M servers.
+
+Simulates many devices, each an M2MClient, that join, log in, send a mix
+of commands and stream route data. The clients in a process are driven
+by a single scheduler thread, so a process can simulate hundreds of
+devices; use several processes for more.
+
+Latency is recorded in logarithmic histograms (about 1% resolution), so
+memory use doesn't grow with the length of a run, and histograms from
+each process are merged for the report. Route data is timestamped, and
+its latency measured when it comes back; the fake server echoes data
+sent to a port with no route, other servers may not.
+
+    python -m m2mclient.loadgen --clients 200 --processes 2 --duration 10
+
+Without a --url, a FakeServer (from tests/ in a source checkout) is
+started in the parent process.
+
+"""
+
+import argparse
+import heapq
+import logging
+import math
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from .client import M2MClient
+from .dispatcher import expose
+from .packets import PacketType
+from . import errors
+
+
+log = logging.getLogger('m2m.loadgen')
+
+COMMANDS = ('set_meta', 'get_meta', 'check_nodes', 'log')
+
+# Send time at the start of route data, as text because packets are
+# decoded as utf-8
+TIMESTAMP_SIZE = 20
+
+
+class Scenario(object):
+    """What each simulated client does."""
+
+    def __init__(self, clients=10, duration=10, command_rate=1,
+                 command_mix=None, route_rate=10, payload_size=256,
+                 route_port=1, transport='lean', ramp_up=0,
+                 username='loadgen', password='loadgen'):
+        self.clients = clients
+        self.duration = duration
+        # Commands and route packets per second, per client
+        self.command_rate = command_rate
+        self.route_rate = route_rate
+        # Command name -> relative weight
+        self.command_mix = command_mix or {name: 1 for name in COMMANDS}
+        for name in self.command_mix:
+            if name not in COMMANDS:
+                raise ValueError('unknown command {!r}'.format(name))
+        # Size in bytes, or a (<min>, <max>) range
+        self.payload_size = payload_size
+        self.route_port = route_port
+        self.transport = transport
+        # Seconds over which to connect the clients
+        self.ramp_up = ramp_up
+        self.username = username
+        self.password = password
+
+    def __repr__(self):
+        return "Scenario(clients={}, duration={})".format(
+            self.clients,
+            self.duration
+        )
+
+    def get_payload_size(self, rng):
+        if isinstance(self.payload_size, int):
+            return self.payload_size
+        low, high = self.payload_size
+        return rng.randint(low, high)
+
+
+class Histogram(object):
+    """Counts values in logarithmic buckets."""
+
+    # Smallest distinct value, and the ratio between buckets
+    MIN_VALUE = 1e-6
+    RATIO = 1.01
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._log_ratio = math.log(self.RATIO)
+
+    def __repr__(self):
+        return "<histogram {} values>".format(self.count)
+
+    def add(self, value):
+        if value <= self.MIN_VALUE:
+            bucket = 0
+        else:
+            bucket = int(math.log(value / self.MIN_VALUE) / self._log_ratio)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, histogram):
+        """Add the values from another histogram."""
+        self.buckets.update(histogram.buckets)
+        self.count += histogram.count
+        self.total += histogram.total
+        self.max = max(self.max, histogram.max)
+
+    def percentile(self, percent):
+        """Get the value at a percentile (0-100), or None if empty."""
+        if not self.count:
+            return None
+        target = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                # Upper edge of the bucket
+                upper = self.MIN_VALUE * self.RATIO ** (bucket + 1)
+                return min(self.max, upper)
+        return self.max
+
+    def summary(self):
+        """Get a dict of count, mean and percentiles."""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p99.9': self.percentile(99.9),
+            'max': self.max if self.count else None,
+        }
+
+
+class Stats(object):
+    """Results from one process."""
+
+    def __init__(self):
+        self.latency = {
+            'connect': Histogram(),
+            'command': Histogram(),
+            'route': Histogram(),
+        }
+        self.counters = Counter()
+        self.elapsed = 0.0
+        # Client threads record route latency
+        self.lock = Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def merge(self, stats):
+        for name, histogram in stats.latency.items():
+            self.latency[name].merge(histogram)
+        self.counters.update(stats.counters)
+        self.elapsed = max(self.elapsed, stats.elapsed)
+
+
+class LoadClient(M2MClient):
+    """A client that records the latency of route data echoed back."""
+
+    stats = None
+
+    @expose(PacketType.route)
+    def handle_route(self, port, data):
+        received_time = time.perf_counter()
+        stats = self.stats
+        with stats.lock:
+            stats.counters['routes_received'] += 1
+            stats.counters['route_bytes_received'] += len(data)
+            try:
+                sent_time = float(data[:TIMESTAMP_SIZE])
+            except ValueError:
+                return
+            stats.latency['route'].add(received_time - sent_time)
+
+    @expose(PacketType.notify_open)
+    def handle_notify_open(self, port):
+        """Routes opened by other clients."""
+
+
+def _connect(url, scenario, stats, start_time=None):
+    """
+    Create and connect a client, or return None if it failed.
+
+    If `start_time` is given, waits until then (on the monotonic clock)
+    before connecting.
+
+    """
+    if start_time is not None:
+        delay = start_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    client = LoadClient(
+        url,
+        scenario.username,
+        scenario.password,
+        transport=scenario.transport
+    )
+    client.stats = stats
+    start = time.perf_counter()
+    try:
+        client.__enter__()
+        identity = client.get_identity()
+    except (errors.ConnectionError, errors.CommandError) as error:
+        log.warning('client failed to connect (%s)', error)
+        try:
+            client.__exit__(None, None, None)
+        except Exception:
+            pass
+        with stats.lock:
+            stats.counters['connect_errors'] += 1
+        return None
+    with stats.lock:
+        stats.latency['connect'].add(time.perf_counter() - start)
+    return client, identity
+
+
+def _send_command(client, identity, name):
+    if name == 'set_meta':
+        return client.set_meta(identity, b'load', b'%i' % time.time())
+    elif name == 'get_meta':
+        return client.get_meta(identity)
+    elif name == 'check_nodes':
+        return client.command('command_check_nodes', nodes=[identity])
+    else:
+        return client.command(
+            'command_log', node=identity, text=b'load test'
+        )
+
+
+def run_process(url, scenario, clients, seed=None):
+    """
+    Run `clients` simulated clients in this process.
+
+    Returns a Stats object.
+
+    """
+    rng = random.Random(seed)
+    stats = Stats()
+    connect_workers = min(32, max(1, clients))
+    ramp_start = time.monotonic()
+    with ThreadPoolExecutor(connect_workers) as executor:
+        # Spread connections over the ramp up period. Start times are
+        # absolute, so a worker's waits don't add up over its clients.
+        futures = [
+            executor.submit(
+                _connect,
+                url,
+                scenario,
+                stats,
+                ramp_start + scenario.ramp_up * index / clients
+            )
+            for index in range(clients)
+        ]
+        connected = [future.result() for future in futures]
+    connected = [client for client in connected if client is not None]
+
+    command_names = list(scenario.command_mix)
+    command_weights = [scenario.command_mix[name] for name in command_names]
+    # (<time>, <client index>, <action>)
+    schedule = []
+    start = time.perf_counter()
+    for index in range(len(connected)):
+        if scenario.command_rate:
+            heapq.heappush(
+                schedule,
+                (start + rng.random() / scenario.command_rate, index, 'c')
+            )
+        if scenario.route_rate:
+            heapq.heappush(
+                schedule,
+                (start + rng.random() / scenario.route_rate, index, 'r')
+            )
+
+    outstanding = []
+    end_time = start + scenario.duration
+    counters = stats.counters
+    lock = stats.lock
+    while schedule:
+        due, index, action = schedule[0]
+        if due >= end_time:
+            break
+        now = time.perf_counter()
+        if due > now:
+            outstanding = _collect(outstanding, stats)
+            time.sleep(min(due - now, 0.01))
+            continue
+        heapq.heappop(schedule)
+        client, identity = connected[index]
+        try:
+            if action == 'c':
+                name = rng.choices(command_names, command_weights)[0]
+                outstanding.append(_send_command(client, identity, name))
+                with lock:
+                    counters['commands_sent'] += 1
+                interval = 1.0 / scenario.command_rate
+            else:
+                size = scenario.get_payload_size(rng)
+                data = b'%020.6f' % time.perf_counter()
+                data += b'.' * max(0, size - len(data))
+                client.send_data(scenario.route_port, data)
+                with lock:
+                    counters['routes_sent'] += 1
+                    counters['route_bytes_sent'] += len(data)
+                interval = 1.0 / scenario.route_rate
+        except (errors.ConnectionError, errors.CommandError) as error:
+            log.debug('client %i error (%s)', index, error)
+            with lock:
+                counters['send_errors'] += 1
+            continue
+        # Exponential intervals, so clients don't synchronise
+        heapq.heappush(
+            schedule,
+            (due + rng.expovariate(1.0 / interval), index, action)
+        )
+
+    # Give outstanding commands a chance to complete
+    give_up = time.perf_counter() + 5
+    while outstanding and time.perf_counter() < give_up:
+        outstanding = _collect(outstanding, stats)
+        time.sleep(0.01)
+    with lock:
+        counters['commands_unanswered'] += len(outstanding)
+    stats.elapsed = time.perf_counter() - start
+
+    for client, _identity in connected:
+        try:
+            client.__exit__(None, None, None)
+        except Exception:
+            log.exception('error closing client')
+    return stats
+
+
+def _collect(outstanding, stats):
+    """Record latency for completed commands, return those still waiting."""
+    waiting = []
+    for result in outstanding:
+        if not result.done:
+            waiting.append(result)
+            continue
+        try:
+            result.get(0)
+        except (errors.ConnectionError, errors.CommandError):
+            with stats.lock:
+                stats.counters['command_errors'] += 1
+        else:
+            with stats.lock:
+                stats.counters['commands_completed'] += 1
+                stats.latency['command'].add(
+                    result.response_time - result.sent_time
+                )
+    return waiting
+
+
+def run(url, scenario, processes=1):
+    """
+    Run a scenario, with clients split between processes.
+
+    Returns a dict with counters, rates and latency summaries.
+
+    """
+    clients_per_process = [
+        scenario.clients // processes +
+        (1 if index < scenario.clients % processes else 0)
+        for index in range(processes)
+    ]
+    if processes == 1:
+        results = [run_process(url, scenario, scenario.clients)]
+    else:
+        from multiprocessing import Pool
+        with Pool(processes) as pool:
+            results = pool.starmap(
+                run_process,
+                [
+                    (url, scenario, clients, index)
+                    for index, clients in enumerate(clients_per_process)
+                ]
+            )
+    stats = Stats()
+    for result in results:
+        stats.merge(result)
+    return get_report(stats)
+
+
+def get_report(stats):
+    """Summarise stats in a dict."""
+    counters = stats.counters
+    elapsed = stats.elapsed or 1.0
+    return {
+        'elapsed': stats.elapsed,
+        'counters': dict(counters),
+        'rates': {
+            'commands': counters['commands_completed'] / elapsed,
+            'routes_sent': counters['routes_sent'] / elapsed,
+            'routes_received': counters['routes_received'] / elapsed,
+            'route_bytes_sent': counters['route_bytes_sent'] / elapsed,
+        },
+        'latency': {
+            name: histogram.summary()
+            for name, histogram in stats.latency.items()
+        },
+    }
+
+
+def print_report(report):
+    print('elapsed  {:.2f}s'.format(report['elapsed']))
+    for name, value in sorted(report['counters'].items()):
+        print('  {:<24}{}'.format(name, value))
+    print('rates (per second)')
+    for name, value in report['rates'].items():
+        print('  {:<24}{:.1f}'.format(name, value))
+    print('latency (ms)  {:>8}{:>8}{:>8}{:>8}{:>8}{:>8}'.format(
+        'count', 'p50', 'p90', 'p99', 'p99.9', 'max'
+    ))
+
+    def format_ms(value):
+        return '-' if value is None else '{:.2f}'.format(value * 1000)
+
+    for name, summary in report['latency'].items():
+        print('  {:<11}{:>8}{:>8}{:>8}{:>8}{:>8}{:>8}'.format(
+            name,
+            summary['count'],
+            format_ms(summary['p50']),
+            format_ms(summary['p90']),
+            format_ms(summary['p99']),
+            format_ms(summary['p99.9']),
+            format_ms(summary['max'])
+        ))
+
+
+def main(argv=None):
+    """Run a load test from the command line."""
+    parser = argparse.ArgumentParser(prog='python -m m2mclient.loadgen')
+    parser.add_argument('--url', default=None,
+                        help='server url (default is a local fake server)')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--ramp-up', type=float, default=0)
+    parser.add_argument('--command-rate', type=float, default=1)
+    parser.add_argument('--route-rate', type=float, default=10)
+    parser.add_argument('--payload-size', default='256',
+                        help='bytes, or a range such as 64-4096')
+    parser.add_argument('--mix', default=None,
+                        help='command weights, such as set_meta=1,log=4')
+    parser.add_argument('--transport', default='lean',
+                        choices=['lean', 'lomond'])
+    parser.add_argument('--username', default='loadgen')
+    parser.add_argument('--password', default='loadgen')
+    args = parser.parse_args(argv)
+
+    if '-' in args.payload_size:
+        low, high = args.payload_size.split('-', 1)
+        payload_size = (int(low), int(high))
+    else:
+        payload_size = int(args.payload_size)
+    command_mix = None
+    if args.mix:
+        command_mix = {}
+        for item in args.mix.split(','):
+            name, _, weight = item.partition('=')
+            command_mix[name.strip()] = float(weight or 1)
+
+    scenario = Scenario(
+        clients=args.clients,
+        duration=args.duration,
+        command_rate=args.command_rate,
+        command_mix=command_mix,
+        route_rate=args.route_rate,
+        payload_size=payload_size,
+        transport=args.transport,
+        ramp_up=args.ramp_up,
+        username=args.username,
+        password=args.password
+    )
+    server = None
+    url = args.url
+    if url is None:
+        try:
+            from tests.fakeserver import FakeServer
+        except ImportError:
+            parser.error(
+                'the fake server needs a source checkout, '
+                'use --url to load test a server'
+            )
+        server = FakeServer()
+        server.start()
+        url = server.url
+    try:
+        report = run(url, scenario, processes=args.processes)
+    finally:
+        if server is not None:
+            server.close()
+    print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,116 @@
+"""
+Memory accounting for long lived clients.
+
+`get_memory_usage(client)` reports the number of items and approximate
+size in bytes of each structure that holds state in a client (pending
+commands, queues, buffers and so on) and the caches shared by all
+clients in the process. Sizes are estimates from `sys.getsizeof`,
+including the contents of containers but not objects they refer to.
+
+The leak regression soak, which compares tracemalloc snapshots over a
+run against a fake server, is in tests/test_memory.py.
+
+"""
+
+import logging
+import sys
+import threading
+from collections import deque
+
+from . import bencode
+from .dispatcher import Dispatcher
+
+
+log = logging.getLogger('m2m.memory')
+
+CONTAINERS = (dict, list, tuple, set, frozenset, deque)
+
+
+def sizeof(obj):
+    """Approximate size of an object and the containers inside it."""
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, CONTAINERS):
+            stack.extend(obj)
+    return size
+
+
+def _usage(container):
+    return {'items': len(container), 'bytes': sizeof(container)}
+
+
+def get_memory_usage(client):
+    """Get a dict of structure name -> {'items': <n>, 'bytes': <n>}."""
+    with client._command_lock:
+        usage = {
+            'command_events': _usage(client.command_events),
+            'command_deadlines': _usage(client._command_deadlines),
+            'coalesced_commands': _usage(client._coalesced),
+        }
+    with client._identity_lock:
+        usage['identity_queue'] = _usage(client._identity_queue)
+    usage['dispatcher_handlers'] = _usage(client.dispatcher._packet_handlers)
+    usage['instructions'] = {
+        'items': len(client.instructions),
+        'bytes': (
+            sizeof(client.instructions._by_sender) +
+            sizeof(client.instructions._by_value)
+        )
+    }
+    if client.outbound is not None:
+        stats = client.outbound.get_stats()
+        usage['outbound'] = {
+            'items': sum(lane['queued'] for lane in stats.values()),
+            'bytes': sum(lane['queued_bytes'] for lane in stats.values())
+        }
+    if client.write_coalescer is not None:
+        with client.write_coalescer._condition:
+            buffers = list(client.write_coalescer._buffers.values())
+            for outgoing in client.write_coalescer._outgoing.values():
+                buffers.extend(outgoing)
+            usage['write_coalescer'] = {
+                'items': len(buffers),
+                'bytes': sum(len(buffer) for buffer in buffers)
+            }
+    if client.flow_control is not None:
+        flow_control = client.flow_control
+        with flow_control._condition:
+            usage['flow_control'] = {
+                'items': len(flow_control._send_credit),
+                'bytes': sum(
+                    sizeof(ports) for ports in (
+                        flow_control._send_credit,
+                        flow_control._buffered,
+                        flow_control._consumed,
+                    )
+                )
+            }
+    if client.spool is not None:
+        usage['spool'] = {'items': None, 'bytes': client.spool.used}
+    usage['buffer_pool'] = {
+        'items': None,
+        'bytes': client.buffer_pool.pooled_bytes
+    }
+
+    # Shared by all clients
+    usage['decode_cache'] = _usage(bencode.DECODE_CACHE)
+    usage['handler_names_cache'] = _usage(Dispatcher._handler_names_cache)
+    usage['threads'] = {
+        'items': sum(
+            1 for thread in threading.enumerate()
+            if thread.name.startswith('m2m')
+        ),
+        'bytes': None
+    }
+    return usage
+
@@ -0,0 +1,231 @@
+"""
+Prioritised sending of outbound packets.
+
+Packets are classified in to lanes by packet type:
+
+control
+    Connection management, keep-alives and pings. Always sent first.
+    Closing a port or leaving isn't in this lane, as it must not
+    overtake data already queued.
+
+command
+    Commands to the server.
+
+bulk
+    Everything else, most notably request_send data.
+
+Control packets are sent before anything else, so they only wait for
+the packet currently being written. The command and bulk lanes share
+what remains by weight, with deficit round robin over the bytes sent, so
+a lane with a large backlog can't starve the other.
+
+If `max_queued_bytes` is set, `put` blocks while the command and bulk
+lanes hold that many bytes, so a fast producer can't queue without
+limit. It raises OutboundFull if there is no room within `timeout`
+seconds. Control packets are never held up. The client waits for up to
+`outbound_timeout` seconds, except on the websocket thread, which must
+keep receiving, so it gets OutboundFull straight away.
+
+"""
+
+import logging
+import time
+from collections import deque
+from threading import Condition
+from threading import Lock
+from threading import Thread
+
+from .packets import PacketType
+from . import errors
+
+
+log = logging.getLogger('m2m.outbound')
+
+CONTROL = 'control'
+COMMAND = 'command'
+BULK = 'bulk'
+
+LANES = (CONTROL, COMMAND, BULK)
+
+CONTROL_PACKETS = frozenset([
+    PacketType.request_join,
+    PacketType.request_identify,
+    PacketType.request_login,
+    PacketType.request_open,
+    PacketType.request_send_control,
+    PacketType.keep_alive,
+    PacketType.ping,
+    PacketType.pong,
+])
+
+
+def classify(packet_type):
+    """Get the lane for a packet type."""
+    if packet_type in CONTROL_PACKETS:
+        return CONTROL
+    if packet_type >= PacketType.response:
+        return COMMAND
+    return BULK
+
+
+class LaneStats(object):
+    """Counters for a single lane."""
+
+    def __init__(self):
+        self.queued = 0
+        self.queued_bytes = 0
+        self.max_queued = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class OutboundScheduler(object):
+    """Queues packets in lanes, and writes them with `send(data)`."""
+
+    def __init__(self, send, command_weight=4, bulk_weight=1,
+                 quantum=16 * 1024, max_queued_bytes=None):
+        self._send = send
+        self.weights = {COMMAND: command_weight, BULK: bulk_weight}
+        self.quantum = quantum
+        self.max_queued_bytes = max_queued_bytes
+        # Bytes queued in the command and bulk lanes
+        self._queued_bytes = 0
+        self._lanes = {lane: deque() for lane in LANES}
+        self._stats = {lane: LaneStats() for lane in LANES}
+        self._deficits = {COMMAND: 0, BULK: 0}
+        self._turn = COMMAND
+        self._turn_started = False
+        lock = Lock()
+        self._condition = Condition(lock)
+        # Notified when there is room in the queue
+        self._space = Condition(lock)
+        self._closed = False
+        self._thread = Thread(
+            target=self._run,
+            name='m2m-outbound',
+            daemon=True
+        )
+        self._thread.start()
+
+    def __repr__(self):
+        return "<outbound {}>".format(
+            ', '.join(
+                '{} {}'.format(lane, len(self._lanes[lane]))
+                for lane in LANES
+            )
+        )
+
+    def put(self, packet_type, data, size=None, timeout=None):
+        """
+        Queue data to be sent.
+
+        `data` is passed to `send` unaltered, so it may be bytes, or a
+        list of buffers if `size` is given.
+
+        """
+        lane = classify(packet_type)
+        if size is None:
+            size = len(data)
+        with self._condition:
+            if self._closed:
+                raise ValueError('outbound scheduler is closed')
+            if lane != CONTROL:
+                self._wait_for_space(size, timeout)
+                self._queued_bytes += size
+            self._lanes[lane].append((data, size, time.monotonic()))
+            stats = self._stats[lane]
+            stats.queued += 1
+            stats.queued_bytes += size
+            if stats.queued > stats.max_queued:
+                stats.max_queued = stats.queued
+            self._condition.notify()
+
+    def _wait_for_space(self, size, timeout):
+        """Block until `size` bytes may be queued (call with the lock)."""
+        max_queued_bytes = self.max_queued_bytes
+        if max_queued_bytes is None:
+            return
+        give_up = None if timeout is None else time.monotonic() + timeout
+        # A packet larger than the limit is queued on its own
+        while (self._queued_bytes and
+                self._queued_bytes + size > max_queued_bytes):
+            wait = None
+            if give_up is not None:
+                wait = give_up - time.monotonic()
+                if wait <= 0:
+                    raise errors.OutboundFull(
+                        '{} bytes already queued'.format(self._queued_bytes)
+                    )
+            self._space.wait(wait)
+            if self._closed:
+                raise ValueError('outbound scheduler is closed')
+
+    def get_stats(self):
+        """Get a dict of counters for each lane."""
+        with self._condition:
+            return {
+                lane: stats.as_dict()
+                for lane, stats in self._stats.items()
+            }
+
+    def close(self, timeout=None):
+        """Send queued packets and stop."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            self._space.notify_all()
+        self._thread.join(timeout)
+
+    def _pop(self):
+        """Get the next (lane, item). Call with a non-empty queue."""
+        lanes = self._lanes
+        if lanes[CONTROL]:
+            return CONTROL, lanes[CONTROL].popleft()
+        deficits = self._deficits
+        while True:
+            lane = self._turn
+            queue = lanes[lane]
+            if queue:
+                if not self._turn_started:
+                    deficits[lane] += self.weights[lane] * self.quantum
+                    self._turn_started = True
+                size = queue[0][1]
+                if deficits[lane] >= size:
+                    deficits[lane] -= size
+                    return lane, queue.popleft()
+            else:
+                # Idle lanes don't save up credit
+                deficits[lane] = 0
+            self._turn = BULK if lane == COMMAND else COMMAND
+            self._turn_started = False
+
+    def _run(self):
+        """Send packets as they are queued."""
+        condition = self._condition
+        lanes = self._lanes
+        while True:
+            with condition:
+                while not any(lanes.values()):
+                    if self._closed:
+                        return
+                    condition.wait()
+                lane, (data, size, queued_time) = self._pop()
+                stats = self._stats[lane]
+                stats.queued -= 1
+                stats.queued_bytes -= size
+                stats.sent += 1
+                stats.sent_bytes += size
+                if lane != CONTROL:
+                    self._queued_bytes -= size
+                    self._space.notify_all()
+                wait = time.monotonic() - queued_time
+                if wait > stats.max_wait:
+                    stats.max_wait = wait
+            try:
+                self._send(data)
+            except Exception:
+                log.exception('failed to send %s packet', lane)
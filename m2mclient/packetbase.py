@@ -11,6 +11,8 @@ be extracted and used as parameters to the handler method.
 
 """
 
+from itertools import accumulate
+
 from .import bencode
 
 class PacketError(Exception):
@@ -25,6 +27,28 @@ class UnknownPacketError(PacketError):
     """A packet we don't know how to handle."""
 
 
+def check_attribute(owner, name, value, _type):
+    """Check an attribute has the right type, return the value to store."""
+    if isinstance(value, str):
+        value = value.encode('utf-8', 'xmlcharreplace')
+    if not isinstance(value, _type):
+        _fmt = "{} parameter '{}' should be a {!r} (not {!r})"
+        raise PacketFormatError(
+            _fmt.format(owner, name, _type, value)
+        )
+    return value
+
+
+def encode_attribute(value):
+    """Encode a single (checked) attribute value."""
+    # Shortcuts for the most common types
+    if value.__class__ is bytes:
+        return b'%i:%s' % (len(value), value)
+    if value.__class__ is int:
+        return b'i%ie' % value
+    return bencode.encode(value)
+
+
 class PacketMeta(type):
     """Maintains a registry of packet classes."""
 
@@ -60,14 +84,7 @@ class PacketBase(metaclass=PacketMeta):
                 raise PacketFormatError(
                     "missing attribute '{}', in {!r}".format(name, self)
                 )
-            value = params[name]
-            if isinstance(value, str):
-                params[name] = value = value.encode('utf-8', 'xmlcharreplace')
-            if not isinstance(value, _type):
-                _fmt = "{} parameter '{}' should be a {!r} (not {!r})"
-                raise PacketFormatError(
-                    _fmt.format(self, name, _type, value)
-                )
+            params[name] = check_attribute(self, name, params[name], _type)
         self.__dict__.update(params)
 
     def __repr__(self):
@@ -101,6 +118,19 @@ class PacketBase(metaclass=PacketMeta):
             raise ValueError('no packet type {}'.format(packet_type))
         return packet_cls(*args, **kwargs)
 
+    @classmethod
+    def prepare(cls, packet_type, **fixed):
+        """
+        Return a PacketTemplate with some attributes fixed in advance.
+
+        The fixed attributes are validated and encoded only once.
+
+        """
+        packet_cls = cls.registry.get(cls.process_packet_type(packet_type))
+        if packet_cls is None:
+            raise ValueError('no packet type {}'.format(packet_type))
+        return PacketTemplate(packet_cls, fixed)
+
     @classmethod
     def from_bytes(cls, packet_bytes):
         """Return a packet from a bytes string."""
@@ -129,6 +159,90 @@ class PacketBase(metaclass=PacketMeta):
             )
         return packet_cls(*packet_body)
 
+    @classmethod
+    def encode_many(cls, packets):
+        """
+        Encode a sequence of packets in to a single bytes object.
+
+        Returns a tuple of (<bytes>, <offsets>), where offsets is a list
+        of the position of each packet within the bytes. The bytes may
+        be decoded again with `decode_stream`.
+
+        """
+        encoded = [packet.as_bytes for packet in packets]
+        sizes = [len(packet_bytes) for packet_bytes in encoded]
+        offsets = list(accumulate([0] + sizes))[:-1]
+        return b''.join(encoded), offsets
+
+    @classmethod
+    def decode_stream(cls, source, chunk_size=64 * 1024):
+        """
+        Generate packets from concatenated encoded packets.
+
+        `source` may be a file-like object opened in binary mode, or an
+        iterable of bytes (which need not be split on packet
+        boundaries). Packets are yielded as soon as they are complete.
+
+        """
+        if hasattr(source, 'read'):
+            read = source.read
+            chunks = iter(lambda: read(chunk_size), b'')
+        else:
+            chunks = source
+        decoder = bencode.Decoder(raw=True)
+        from_bytes = cls.from_bytes
+        try:
+            for chunk in chunks:
+                for packet_bytes in decoder.feed(chunk):
+                    yield from_bytes(packet_bytes)
+            decoder.close()
+        except bencode.DecodeError as error:
+            raise PacketFormatError(
+                'packet stream is badly formatted ({})'.format(error)
+            )
+
+    @classmethod
+    def view(cls, packet_bytes):
+        """
+        Return a lazily decoded PacketView from a bytes string.
+
+        The packet type is decoded immediately, and the attributes are
+        decoded only when accessed.
+
+        """
+        if not packet_bytes.startswith(b'li'):
+            raise PacketFormatError('first value must be an integer')
+        try:
+            pos = bencode.scan(packet_bytes, 1)
+            packet_type = int(packet_bytes[2:pos - 1])
+        except (bencode.DecodeError, ValueError) as error:
+            raise PacketFormatError(
+                'packet is badly formatted ({})'.format(error)
+            )
+        try:
+            packet_cls = cls.registry[packet_type]
+        except KeyError:
+            raise UnknownPacketError(
+                "unknown packet ({!r})".format(packet_type)
+            )
+        offsets = {}
+        try:
+            for name, _type in packet_cls.attributes:
+                if packet_bytes[pos:pos + 1] == b'e':
+                    raise PacketFormatError(
+                        "missing attribute '{}', in {!r}".format(
+                            name, packet_cls
+                        )
+                    )
+                end = bencode.scan(packet_bytes, pos)
+                offsets[name] = (pos, end)
+                pos = end
+        except bencode.DecodeError as error:
+            raise PacketFormatError(
+                'packet is badly formatted ({})'.format(error)
+            )
+        return PacketView(packet_cls, packet_bytes, offsets)
+
     @property
     def kwargs(self):
         """Keyword args to be used to invoke handler."""
@@ -145,3 +259,192 @@ class PacketBase(metaclass=PacketMeta):
             [getattr(self, name) for name, _type in self.attributes]
         )
         return packet_bytes
+
+    @property
+    def as_buffers(self):
+        """
+        Encode the packet as a list of buffers.
+
+        Packets with a large payload may return the payload as a
+        separate buffer, so that it isn't copied when encoding.
+
+        """
+        return [self.as_bytes]
+
+
+class PacketView(object):
+    """
+    A packet that decodes attributes on first access.
+
+    Useful when only some attributes (often just type and port) are
+    required, such as when routing or filtering packets. Attributes are
+    validated as they are decoded, so a badly formatted attribute will
+    raise a PacketFormatError when accessed.
+
+    """
+
+    def __init__(self, packet_cls, packet_bytes, offsets):
+        self.packet_cls = packet_cls
+        self.type = packet_cls.type
+        self.attributes = packet_cls.attributes
+        self.as_bytes = packet_bytes
+        self.as_buffers = [packet_bytes]
+        self._offsets = offsets
+
+    def __repr__(self):
+        return "{}View({})".format(
+            self.packet_cls.__name__,
+            ', '.join(name for name, _type in self.attributes)
+        )
+
+    def __getattr__(self, name):
+        # Only called if the attribute hasn't been decoded yet
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            start, end = self._offsets[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = self._decode_attribute(
+            self.as_bytes[start:end],
+            dict(self.attributes)[name]
+        )
+        setattr(self, name, value)
+        return value
+
+    def _decode_attribute(self, value_bytes, _type):
+        """Decode and validate a single attribute."""
+        try:
+            if _type is bytes and value_bytes[:1].isdigit():
+                # Strings may be sliced out without decoding
+                return value_bytes[value_bytes.index(b':') + 1:]
+            if _type is int and value_bytes.startswith(b'i'):
+                return int(value_bytes[1:-1])
+            value = bencode.decode(value_bytes)
+        except (bencode.DecodeError, ValueError) as error:
+            raise PacketFormatError(
+                'packet is badly formatted ({})'.format(error)
+            )
+        if isinstance(value, str):
+            value = value.encode('utf-8', 'xmlcharreplace')
+        if not isinstance(value, _type):
+            _fmt = "{} parameter should be a {!r} (not {!r})"
+            raise PacketFormatError(_fmt.format(self, _type, value))
+        return value
+
+    @property
+    def kwargs(self):
+        """Keyword args to be used to invoke handler."""
+        return {
+            name: getattr(self, name)
+            for name, _ in self.attributes
+        }
+
+    @property
+    def packet(self):
+        """The fully decoded packet."""
+        return self.packet_cls(**self.kwargs)
+
+
+class PacketTemplate(object):
+    """
+    A packet with some attributes encoded in advance.
+
+    The encoded packet is stored as a list of parts, which are either
+    pre-encoded bytes, or the name and type of an attribute to be
+    encoded when the packet is created.
+
+    """
+
+    def __init__(self, packet_cls, fixed):
+        self.packet_cls = packet_cls
+        attribute_names = {name for name, _type in packet_cls.attributes}
+        for name in fixed:
+            if name not in attribute_names:
+                raise PacketFormatError(
+                    "{!r} has no attribute '{}'".format(packet_cls, name)
+                )
+        self.fixed = {
+            name: check_attribute(packet_cls, name, fixed[name], _type)
+            for name, _type in packet_cls.attributes
+            if name in fixed
+        }
+        self.variables = [
+            (name, _type)
+            for name, _type in packet_cls.attributes
+            if name not in fixed
+        ]
+        parts = []
+        encoded = [b'li%ie' % packet_cls.type]
+        for name, _type in packet_cls.attributes:
+            if name in self.fixed:
+                encoded.append(encode_attribute(self.fixed[name]))
+            else:
+                parts.append(b''.join(encoded))
+                parts.append((name, _type))
+                encoded = []
+        encoded.append(b'e')
+        parts.append(b''.join(encoded))
+        self._parts = [part for part in parts if part != b'']
+
+    def __repr__(self):
+        return "PacketTemplate({}, {})".format(
+            self.packet_cls.__name__,
+            ', '.join(name for name, _type in self.variables)
+        )
+
+    def create(self, *args, **kwargs):
+        """Create a PreparedPacket from the variable attributes."""
+        params = {
+            name: arg
+            for arg, (name, _type) in zip(args, self.variables)
+        }
+        params.update(kwargs)
+        packet_cls = self.packet_cls
+        encoded = []
+        append = encoded.append
+        for part in self._parts:
+            if part.__class__ is bytes:
+                append(part)
+                continue
+            name, _type = part
+            try:
+                value = params[name]
+            except KeyError:
+                raise PacketFormatError(
+                    "missing attribute '{}', in {!r}".format(name, self)
+                )
+            params[name] = value = check_attribute(
+                packet_cls, name, value, _type
+            )
+            append(encode_attribute(value))
+        params.update(self.fixed)
+        return PreparedPacket(packet_cls, b''.join(encoded), params)
+
+
+class PreparedPacket(object):
+    """A packet created from a PacketTemplate, which is already encoded."""
+
+    def __init__(self, packet_cls, packet_bytes, params):
+        self.packet_cls = packet_cls
+        self.type = packet_cls.type
+        self.attributes = packet_cls.attributes
+        self.as_bytes = packet_bytes
+        self.as_buffers = [packet_bytes]
+        self.__dict__.update(params)
+
+    def __repr__(self):
+        return "Prepared{!r}".format(self.packet)
+
+    @property
+    def kwargs(self):
+        """Keyword args to be used to invoke handler."""
+        return {
+            name: getattr(self, name)
+            for name, _ in self.attributes
+        }
+
+    @property
+    def packet(self):
+        """The equivalent packet object."""
+        return self.packet_cls(**self.kwargs)
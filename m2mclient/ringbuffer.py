@@ -0,0 +1,323 @@
+"""
+A ring buffer of variable sized records in shared memory.
+
+Used to hand route data to consumer processes without pickling or
+sending each message over a pipe. There should be a single writer and a
+single reader. If the reader can't keep up, new records are dropped
+(and counted) rather than blocking the writer.
+
+The buffer starts with a header, followed by the ring of records:
+
+    <uint64 write position> <uint64 read position> <uint64 dropped>
+
+Positions are byte counts that only ever increase. Each record is a
+uint32 size followed by the record data. If a record won't fit before
+the end of the ring, a padding marker is written and the record starts
+at the beginning of the ring.
+
+    # Producer
+    ring = SharedRingBuffer(size=16 * 1024 * 1024)
+    client = M2MClient(url, user, password, route_sink=RouteSink(ring))
+
+    # Consumer process
+    reader = RouteReader(ring.name)
+    port, data = reader.read(timeout=1)
+
+"""
+
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+
+HEADER = struct.Struct('<QQQ')
+HEADER_SIZE = 64
+SIZE = struct.Struct('<I')
+PADDING = 0xFFFFFFFF
+PORT = struct.Struct('<q')
+
+# Shared memory created by this process (or its parent, if forked)
+_created = set()
+
+
+def _untrack(memory):
+    """
+    Stop the resource tracker unlinking shared memory we attached to.
+
+    Before Python 3.13, attaching registers the memory with this
+    process's resource tracker, which unlinks it when the process exits.
+    Unless the tracker is shared with the creator, in which case the
+    registration is the creator's.
+
+    """
+    tracker = resource_tracker._resource_tracker
+    # Processes started by multiprocessing inherit the tracker, without
+    # having started it
+    inherited = tracker._fd is not None and tracker._pid is None
+    if memory.name not in _created and not inherited:
+        resource_tracker.unregister(memory._name, 'shared_memory')
+
+
+class RingBuffer(object):
+    """A ring buffer of records, in any writable buffer."""
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.capacity = len(self.buffer) - HEADER_SIZE
+        if self.capacity <= SIZE.size:
+            raise ValueError('buffer is too small')
+        self._next_read = None
+
+    def __repr__(self):
+        return "<ringbuffer {} of {} bytes used>".format(
+            self.used,
+            self.capacity
+        )
+
+    def _get_positions(self):
+        """Get write position, read position and dropped count."""
+        return HEADER.unpack_from(self.buffer, 0)
+
+    @property
+    def used(self):
+        """Number of bytes in use."""
+        write_pos, read_pos, _dropped = self._get_positions()
+        return write_pos - read_pos
+
+    @property
+    def dropped(self):
+        """Number of records dropped because the buffer was full."""
+        return self._get_positions()[2]
+
+    def reset(self):
+        """Discard all records."""
+        HEADER.pack_into(self.buffer, 0, 0, 0, 0)
+
+    def can_fit(self, size):
+        """Check if a record of `size` bytes would fit once emptied."""
+        write_pos, _read_pos, _dropped = self._get_positions()
+        tail = self.capacity - write_pos % self.capacity
+        required = SIZE.size + size
+        padding = tail if required > tail else 0
+        return padding + required <= self.capacity
+
+    def put(self, *parts):
+        """
+        Write a record made up of one or more bytes-like parts.
+
+        Returns True if the record was written, or False if it was
+        dropped because there wasn't enough room.
+
+        """
+        buffer = self.buffer
+        capacity = self.capacity
+        size = sum(len(part) for part in parts)
+        write_pos, read_pos, dropped = self._get_positions()
+        offset = write_pos % capacity
+        tail = capacity - offset
+        required = SIZE.size + size
+        padding = tail if required > tail else 0
+        if padding + required > capacity - (write_pos - read_pos):
+            struct.pack_into('<Q', buffer, 16, dropped + 1)
+            return False
+        if padding:
+            if padding >= SIZE.size:
+                SIZE.pack_into(buffer, HEADER_SIZE + offset, PADDING)
+            offset = 0
+        position = HEADER_SIZE + offset
+        SIZE.pack_into(buffer, position, size)
+        position += SIZE.size
+        for part in parts:
+            part_size = len(part)
+            buffer[position:position + part_size] = part
+            position += part_size
+        # Publish the record only after it has been written
+        struct.pack_into('<Q', buffer, 0, write_pos + padding + required)
+        return True
+
+    def _read_at(self, read_pos, write_pos):
+        """Get (<record view>, <next read position>), or None."""
+        buffer = self.buffer
+        capacity = self.capacity
+        while read_pos < write_pos:
+            offset = read_pos % capacity
+            tail = capacity - offset
+            if tail < SIZE.size:
+                read_pos += tail
+                continue
+            (size,) = SIZE.unpack_from(buffer, HEADER_SIZE + offset)
+            if size == PADDING:
+                read_pos += tail
+                continue
+            start = HEADER_SIZE + offset + SIZE.size
+            return (
+                buffer[start:start + size],
+                read_pos + SIZE.size + size
+            )
+        return None
+
+    def peek(self):
+        """
+        Get a memoryview of the next record, without removing it.
+
+        Returns None if the buffer is empty. The view is only valid
+        until `advance` is called.
+
+        """
+        write_pos, read_pos, _dropped = self._get_positions()
+        record = self._read_at(read_pos, write_pos)
+        if record is None:
+            return None
+        record, self._next_read = record
+        return record
+
+    def peek_many(self, max_bytes, max_records=None):
+        """
+        Copy records from the start of the buffer, without removing them.
+
+        Returns a list of bytes, and the position to pass to `advance`
+        to remove them. At least one record is returned if the buffer
+        isn't empty, even if it is larger than `max_bytes`. No more
+        than `max_records` are returned, if it is given.
+
+        """
+        write_pos, read_pos, _dropped = self._get_positions()
+        records = []
+        total = 0
+        while total < max_bytes:
+            if max_records is not None and len(records) >= max_records:
+                break
+            record = self._read_at(read_pos, write_pos)
+            if record is None:
+                break
+            record, read_pos = record
+            records.append(bytes(record))
+            total += len(record)
+            record.release()
+        return records, read_pos
+
+    def advance(self, position=None):
+        """
+        Remove the record returned by `peek`.
+
+        If `position` is given (from `peek_many`), remove the records
+        before it, unless they were already removed.
+
+        """
+        if position is not None:
+            read_pos = self._get_positions()[1]
+            if position > read_pos:
+                struct.pack_into('<Q', self.buffer, 8, position)
+            self._next_read = None
+        elif self._next_read is not None:
+            struct.pack_into('<Q', self.buffer, 8, self._next_read)
+            self._next_read = None
+
+    def get(self):
+        """Remove and return the next record as bytes, or None."""
+        record = self.peek()
+        if record is None:
+            return None
+        record_bytes = bytes(record)
+        record.release()
+        self.advance()
+        return record_bytes
+
+
+class SharedRingBuffer(RingBuffer):
+    """A RingBuffer in named shared memory."""
+
+    def __init__(self, name=None, size=1024 * 1024, create=True):
+        if create:
+            self.shared_memory = shared_memory.SharedMemory(
+                name=name,
+                create=True,
+                size=HEADER_SIZE + size
+            )
+            _created.add(self.shared_memory.name)
+        else:
+            try:
+                # Don't let this process delete memory the creator owns
+                self.shared_memory = shared_memory.SharedMemory(
+                    name=name,
+                    track=False
+                )
+            except TypeError:
+                # Python < 3.13 always tracks shared memory
+                self.shared_memory = shared_memory.SharedMemory(name=name)
+                _untrack(self.shared_memory)
+        self.name = self.shared_memory.name
+        self.owner = create
+        super().__init__(self.shared_memory.buf)
+        if create:
+            self.reset()
+
+    def close(self):
+        """Detach from the shared memory, and delete it if we created it."""
+        self.buffer.release()
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
+            _created.discard(self.name)
+
+
+class RouteSink(object):
+    """
+    Writes route data for selected ports to a ring buffer.
+
+    If `ports` is None, data for all ports is written.
+
+    """
+
+    def __init__(self, ring, ports=None):
+        self.ring = ring
+        self.ports = None if ports is None else set(ports)
+
+    def accepts(self, port):
+        """Check if data for a port should go to the ring buffer."""
+        return self.ports is None or port in self.ports
+
+    def write(self, port, data):
+        """Write route data, return False if it was dropped."""
+        return self.ring.put(PORT.pack(port), data)
+
+
+class RouteReader(object):
+    """Reads route data written by a RouteSink, in another process."""
+
+    def __init__(self, name):
+        self.ring = SharedRingBuffer(name, create=False)
+
+    def close(self):
+        self.ring.close()
+
+    def read(self, timeout=0, poll_interval=0.001):
+        """
+        Get the next (<port>, <data>), or None if there is no data.
+
+        Will wait up to `timeout` seconds for data to arrive.
+
+        """
+        ring = self.ring
+        record = ring.peek()
+        if record is None and timeout:
+            give_up = time.monotonic() + timeout
+            while record is None and time.monotonic() < give_up:
+                time.sleep(poll_interval)
+                record = ring.peek()
+        if record is None:
+            return None
+        (port,) = PORT.unpack_from(record)
+        data = bytes(record[PORT.size:])
+        record.release()
+        ring.advance()
+        return port, data
+
+    def __iter__(self):
+        """Iterate over records currently in the buffer."""
+        while True:
+            route = self.read()
+            if route is None:
+                break
+            yield route
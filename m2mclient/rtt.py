@@ -0,0 +1,61 @@
+"""
+Round trip time estimation for commands.
+
+Follows the retransmission timeout calculation of TCP (RFC 6298): a
+smoothed mean of the round trip time, and a smoothed mean deviation.
+The timeout is the mean plus four deviations, clamped between a floor
+and a ceiling. Until there is a sample, the timeout is the ceiling.
+
+"""
+
+from threading import Lock
+
+
+class RTTEstimator(object):
+    """Computes a command timeout from observed round trip times."""
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, floor=0.05, ceiling=5.0):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "<rtt srtt={} rttvar={} timeout={:.3f}>".format(
+            self.srtt,
+            self.rttvar,
+            self.timeout
+        )
+
+    def reset(self):
+        """Forget samples, when connecting to a different server."""
+        with self._lock:
+            self.srtt = None
+            self.rttvar = None
+            self.samples = 0
+
+    def update(self, rtt):
+        """Add a round trip time sample, in seconds."""
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+                self.srtt += self.ALPHA * (rtt - self.srtt)
+            self.samples += 1
+
+    @property
+    def timeout(self):
+        """The current timeout, in seconds."""
+        srtt = self.srtt
+        if srtt is None:
+            return self.ceiling
+        timeout = srtt + self.K * self.rttvar
+        return min(self.ceiling, max(self.floor, timeout))
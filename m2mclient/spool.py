@@ -0,0 +1,298 @@
+"""
+A disk backed spool for packets sent while disconnected.
+
+Rather than dropping packets when the server is gone, the client can
+append them to a spool: a RingBuffer in a memory mapped file of a fixed
+size. The spool survives a restart of the process, so a new client with
+the same `spool_path` can send what the last one couldn't.
+
+Only route data (request_send and request_close) and logs are spooled.
+Ports belong to the session they were opened in, so the spool records
+the session identity, and anything spooled in another session is
+discarded when the server sets the identity. Commands would refer to
+other commands in a later session, and keep alives, pings and other
+control packets are only useful if they are sent straight away, so none
+of those are spooled. A command sent while offline fails immediately.
+
+Once the client has its identity, the spool is flushed in the
+background, in batches of up to `batch_size` bytes or `batch_records`
+packets (many small packets would make a single write too large for the
+OS). Consecutive request_send packets to the same port are merged in to
+a single packet, and batches are written back to back. If `rate` is
+set, flushing is limited to that many bytes per second, so a backlog
+doesn't swamp a slow link. Until the spool is empty, new route data is
+spooled behind the older data, so data for a port stays in order. Other
+packets are sent immediately.
+
+When the spool is full, the `policy` decides what to lose:
+
+drop_new
+    New packets are dropped (the default).
+
+drop_old
+    The oldest packets are dropped to make room.
+
+"""
+
+import logging
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+
+from .packets import M2MPacket
+from .packets import PacketType
+from .ringbuffer import HEADER
+from .ringbuffer import HEADER_SIZE
+from .ringbuffer import RingBuffer
+
+
+log = logging.getLogger('m2m.spool')
+
+# Packet type and port (-1 if the packet isn't request_send)
+RECORD = struct.Struct('<Hq')
+
+# Length and identity of the session, stored after the ring's header
+SESSION = struct.Struct('<B39s')
+SESSION_OFFSET = HEADER.size
+MAX_SESSION_SIZE = 39
+
+SPOOLED_PACKETS = frozenset([
+    PacketType.request_send,
+    PacketType.request_close,
+    PacketType.log,
+])
+
+DROP_NEW = 'drop_new'
+DROP_OLD = 'drop_old'
+
+
+def is_spooled(packet):
+    """Check if a packet may be spooled."""
+    return packet.type in SPOOLED_PACKETS
+
+
+class OutboundSpool(object):
+    """Spools encoded packets to a memory mapped file."""
+
+    def __init__(self, path, size=16 * 1024 * 1024, policy=DROP_NEW,
+                 rate=None, batch_size=256 * 1024, batch_records=256):
+        if policy not in (DROP_NEW, DROP_OLD):
+            raise ValueError("policy should be 'drop_new' or 'drop_old'")
+        self.path = path
+        self.size = size
+        self.policy = policy
+        self.rate = rate
+        self.batch_size = batch_size
+        self.batch_records = batch_records
+        self._lock = Lock()
+        self._closed = False
+        file_size = HEADER_SIZE + size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            reuse = os.fstat(fd).st_size == file_size
+            if not reuse:
+                os.ftruncate(fd, file_size)
+            self._mmap = mmap.mmap(fd, file_size)
+        finally:
+            os.close(fd)
+        self.ring = RingBuffer(self._mmap)
+        write_pos, read_pos, _dropped = HEADER.unpack_from(self._mmap, 0)
+        valid = read_pos <= write_pos <= read_pos + self.ring.capacity
+        if not reuse or not valid:
+            self.ring.reset()
+        elif write_pos > read_pos:
+            log.info(
+                'spool %s has %i bytes from a previous session',
+                path,
+                write_pos - read_pos
+            )
+
+    def __repr__(self):
+        return "OutboundSpool({!r}, size={}, policy={!r})".format(
+            self.path,
+            self.size,
+            self.policy
+        )
+
+    @property
+    def used(self):
+        """Number of bytes spooled."""
+        return self.ring.used
+
+    @property
+    def dropped(self):
+        """Number of packets dropped because the spool was full."""
+        return self.ring.dropped
+
+    @property
+    def session(self):
+        """The identity of the session spooled packets belong to."""
+        size, session = SESSION.unpack_from(self._mmap, SESSION_OFFSET)
+        return session[:size]
+
+    def set_session(self, identity):
+        """
+        Set the session identity, when the server sets it.
+
+        Packets spooled in another session are discarded, as their ports
+        refer to nothing (or the wrong route) in this one. Returns the
+        number of bytes discarded.
+
+        """
+        identity = identity[:MAX_SESSION_SIZE]
+        with self._lock:
+            if self._closed or identity == self.session:
+                return 0
+            discarded = self.ring.used
+            if discarded:
+                log.info(
+                    'discarding %i bytes spooled in another session',
+                    discarded
+                )
+                write_pos, _read_pos, _dropped = HEADER.unpack_from(
+                    self._mmap,
+                    0
+                )
+                # Rather than a reset, so a flush in progress can't move
+                # the read position back
+                self.ring.advance(write_pos)
+            SESSION.pack_into(
+                self._mmap,
+                SESSION_OFFSET,
+                len(identity),
+                identity
+            )
+            return discarded
+
+    def put(self, packet):
+        """
+        Spool a packet.
+
+        Returns True if the packet was spooled, or False if it was
+        dropped.
+
+        """
+        if not is_spooled(packet):
+            log.debug('not spooled, dropped %r', packet)
+            return False
+        with self._lock:
+            return self._put(packet)
+
+    def _put(self, packet):
+        """Spool a packet (call with the lock held)."""
+        if packet.type == PacketType.request_send:
+            parts = [RECORD.pack(packet.type, packet.port), packet.data]
+        else:
+            parts = [RECORD.pack(packet.type, -1)] + packet.as_buffers
+        ring = self.ring
+        if ring.put(*parts):
+            return True
+        size = sum(len(part) for part in parts)
+        if self.policy == DROP_OLD and ring.can_fit(size):
+            while ring.get() is not None:
+                if ring.put(*parts):
+                    return True
+        log.debug('spool is full, dropped %r', packet)
+        return False
+
+    def put_if_pending(self, packet):
+        """
+        Spool a packet if older packets are waiting to be sent, so that
+        it isn't sent before them.
+
+        Returns False if the packet should be sent now, which is always
+        the case for packets that aren't spooled.
+
+        """
+        if not is_spooled(packet):
+            return False
+        with self._lock:
+            if self._closed or not self.ring.used:
+                return False
+            self._put(packet)
+            return True
+
+    def flush(self, send):
+        """
+        Send spooled packets with `send(packets)`.
+
+        `send` is called with a list of encoded (<packet type>, <packet
+        bytes>) in each batch, and should raise an exception if they
+        couldn't be sent, in which case they stay in the spool.
+
+        Returns the number of packets sent.
+
+        """
+        sent = 0
+        start_time = time.monotonic()
+        sent_bytes = 0
+        while True:
+            with self._lock:
+                if self._closed:
+                    break
+                records, position = self.ring.peek_many(
+                    self.batch_size,
+                    self.batch_records
+                )
+            if not records:
+                break
+            packets = self._merge(records)
+            send(packets)
+            with self._lock:
+                if self._closed:
+                    break
+                self.ring.advance(position)
+            sent += len(packets)
+            sent_bytes += sum(
+                len(packet_bytes) for _type, packet_bytes in packets
+            )
+            if self.rate:
+                delay = start_time + sent_bytes / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        if sent:
+            log.info('sent %i spooled packets (%i bytes)', sent, sent_bytes)
+        return sent
+
+    def _merge(self, records):
+        """Decode records, merging data for consecutive request_send."""
+        packets = []
+        port = None
+        data = []
+
+        def add_data():
+            if data:
+                packet = M2MPacket.create(
+                    PacketType.request_send,
+                    port=port,
+                    data=b''.join(data)
+                )
+                packets.append((packet.type, packet.as_bytes))
+                del data[:]
+
+        record_size = RECORD.size
+        for record in records:
+            packet_type, record_port = RECORD.unpack_from(record)
+            if packet_type == PacketType.request_send:
+                if record_port != port:
+                    add_data()
+                    port = record_port
+                data.append(record[record_size:])
+            else:
+                add_data()
+                port = None
+                packets.append((packet_type, record[record_size:]))
+        add_data()
+        return packets
+
+    def close(self):
+        """Write the spool to disk and unmap it."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self.ring.buffer.release()
+            self._mmap.flush()
+            self._mmap.close()
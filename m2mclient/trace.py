@@ -0,0 +1,68 @@
+"""
+Debug logging of packets on the hot path.
+
+Callers check the plain `enabled` attribute before calling, so when
+debug logging is off the cost per packet is a single attribute lookup.
+The enabled flag is computed from the logger when the trace is created,
+and should be updated with `refresh()` if the log level changes.
+
+Packets may be sampled (only every Nth packet is logged), and logged as
+structured fields (type, port, size and command_id) rather than a repr
+of the whole packet. Structured fields are also passed to log handlers
+in the `m2m` attribute of the log record.
+
+"""
+
+import logging
+
+
+class PacketTrace(object):
+    """Logs packets sent and received."""
+
+    def __init__(self, log, sample=1, structured=False):
+        self.log = log
+        self.sample = max(1, int(sample))
+        self.structured = structured
+        self.enabled = False
+        self._count = 0
+        self.refresh()
+
+    def __repr__(self):
+        return "PacketTrace({!r}, sample={}, structured={!r})".format(
+            self.log.name,
+            self.sample,
+            self.structured
+        )
+
+    def refresh(self):
+        """Update `enabled` from the logger's level."""
+        self.enabled = self.log.isEnabledFor(logging.DEBUG)
+
+    def inbound(self, packet, size):
+        """Log a packet that was received."""
+        self._trace('<-', packet, size)
+
+    def outbound(self, packet, size):
+        """Log a packet that was sent."""
+        self._trace('->', packet, size)
+
+    def _trace(self, direction, packet, size):
+        self._count += 1
+        if self._count % self.sample:
+            return
+        if not self.structured:
+            self.log.debug(' %s %r', direction, packet)
+            return
+        fields = {
+            'direction': direction,
+            'type': getattr(packet.type, 'name', packet.type),
+            'port': getattr(packet, 'port', None),
+            'size': size,
+            'command_id': getattr(packet, 'command_id', None),
+        }
+        self.log.debug(
+            ' %(direction)s type=%(type)s port=%(port)s size=%(size)s '
+            'command_id=%(command_id)s',
+            fields,
+            extra={'m2m': fields}
+        )
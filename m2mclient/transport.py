@@ -0,0 +1,425 @@
+"""
+A lean WebSocket transport for M2M.
+
+M2M only uses binary messages, so rather than building an event object
+for every frame, this transport parses frames directly from a bytearray
+receive buffer (filled with `recv_into`) and hands binary payloads
+straight to the packet decoder. Pings are answered, text messages are
+ignored.
+
+Select it with `M2MClient(url, username, password, transport='lean')`.
+Socket options are a list of (<level>, <option>, <value>) tuples, passed
+to `setsockopt` before connecting. The default disables Nagle's
+algorithm, so small packets (such as commands) aren't delayed.
+
+Receive buffers come from the client's BufferPool. Payloads are passed
+on as views of the buffer rather than copies, and with `route_views`
+set, route data reaches handlers without being copied at all.
+
+"""
+
+import logging
+import socket
+import ssl
+import struct
+import time
+from threading import Lock
+from threading import Timer
+from urllib.parse import urlparse
+
+from .bufferpool import BufferPool
+from .client import WebSocketThread
+from .client import get_agent
+from . import errors
+from . import wsframe
+
+
+log = logging.getLogger('m2m.transport')
+
+DEFAULT_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+]
+
+# Largest HTTP response to the upgrade request
+MAX_RESPONSE_SIZE = 16 * 1024
+
+
+def open_websocket(url, socket_options=None, timeout=10, agent=None):
+    """
+    Connect a socket, and upgrade it to a websocket.
+
+    Returns the socket, and any data received after the handshake.
+
+    """
+    if socket_options is None:
+        socket_options = DEFAULT_SOCKET_OPTIONS
+    url = urlparse(url)
+    secure = url.scheme == 'wss'
+    port = url.port or (443 if secure else 80)
+    sock = socket.create_connection((url.hostname, port), timeout)
+    try:
+        for level, option, value in socket_options:
+            sock.setsockopt(level, option, value)
+        if secure:
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=url.hostname)
+        data = _handshake(sock, url, agent)
+    except Exception:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock, data
+
+
+def _handshake(sock, url, agent):
+    """Send the upgrade request, return data after the response."""
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    key = wsframe.make_key()
+    request = (
+        'GET {} HTTP/1.1\r\n'
+        'Host: {}\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Key: {}\r\n'
+        'Sec-WebSocket-Version: 13\r\n'
+        'User-Agent: {}\r\n'
+        '\r\n'
+    ).format(
+        path,
+        url.netloc.rpartition('@')[-1],
+        key.decode(),
+        agent or get_agent()
+    )
+    sock.sendall(request.encode())
+
+    response = b''
+    while b'\r\n\r\n' not in response:
+        if len(response) > MAX_RESPONSE_SIZE:
+            raise errors.ConnectionError('response is too large')
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise errors.ConnectionError('server closed connection')
+        response += chunk
+    header, _, data = response.partition(b'\r\n\r\n')
+    status_line, *header_lines = header.decode('latin-1').split('\r\n')
+    status = status_line.split(' ', 2)
+    if len(status) < 2 or status[1] != '101':
+        raise errors.ConnectionError(
+            'websocket upgrade rejected ({})'.format(status_line)
+        )
+    headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('sec-websocket-accept') != \
+            wsframe.get_accept(key).decode():
+        raise errors.ConnectionError('invalid websocket accept header')
+    return data
+
+
+class LeanWebSocketThread(WebSocketThread):
+    """Websocket thread with a built-in binary only transport."""
+
+    def __init__(self, url, client, on_startup=None, socket_options=None,
+                 recv_size=64 * 1024, max_frame_size=64 * 1024 * 1024,
+                 connect_timeout=10, close_timeout=5, buffer_pool=None,
+                 max_message_size=None):
+        super().__init__(url, client, on_startup=on_startup)
+        self.buffer_pool = buffer_pool or BufferPool()
+        self.socket_options = (
+            DEFAULT_SOCKET_OPTIONS
+            if socket_options is None else socket_options
+        )
+        self.recv_size = recv_size
+        self.max_frame_size = max_frame_size
+        # Total size of a fragmented message
+        self.max_message_size = max_message_size or max_frame_size
+        self.connect_timeout = connect_timeout
+        self.close_timeout = close_timeout
+        self.sock = None
+        self._send_lock = Lock()
+        self._closing = False
+
+    def create_websocket(self, url):
+        """The socket is created when the thread starts."""
+        return None
+
+    def run(self):
+        """Main thread loop."""
+        try:
+            try:
+                data = self.connect()
+            except (OSError, errors.ConnectionError) as error:
+                self.error = str(error) or 'unable to connect'
+                return
+            self.running = True
+            self.on_startup()
+            self.ready_event.set()
+            self.receive(data)
+        except Exception:
+            log.exception('error in m2m thread')
+        finally:
+            self.running = False
+            self.ready_event.set()
+            if self.sock is not None:
+                self.sock.close()
+
+    def connect(self):
+        """
+        Connect and upgrade to a websocket.
+
+        Returns any data received after the handshake.
+
+        """
+        self.sock, data = open_websocket(
+            self.url,
+            socket_options=self.socket_options,
+            timeout=self.connect_timeout,
+            agent=self.AGENT
+        )
+        return data
+
+    def receive(self, data=b''):
+        """Receive and dispatch frames until the connection closes."""
+        recv_size = self.recv_size
+        max_frame_size = self.max_frame_size
+        max_message_size = self.max_message_size
+        parse_frame = wsframe.parse_frame
+        recv_into = self.sock.recv_into
+        on_binary = self.on_binary
+        pool = self.buffer_pool
+        base_size = pool.get_size(recv_size)
+
+        buffer = pool.acquire(max(recv_size, len(data)))
+        buffer[:len(data)] = data
+        start = 0
+        end = len(data)
+        # Opcode, payloads and size of a fragmented message
+        message_opcode = None
+        fragments = []
+        message_size = 0
+
+        try:
+            while True:
+                while True:
+                    frame = parse_frame(
+                        buffer, start, end, max_frame_size, copy=False
+                    )
+                    if frame is None:
+                        break
+                    fin, opcode, payload, start = frame
+                    if opcode == wsframe.OPCODE_CONTINUATION:
+                        if message_opcode is None:
+                            raise wsframe.FrameError(
+                                'unexpected continuation'
+                            )
+                        message_size += len(payload)
+                        if message_size > max_message_size:
+                            raise wsframe.FrameError(
+                                'message is too large'
+                            )
+                        if message_opcode == wsframe.OPCODE_BINARY:
+                            # Text is ignored, so isn't kept
+                            fragments.append(payload.tobytes())
+                        if fin:
+                            if message_opcode == wsframe.OPCODE_BINARY:
+                                on_binary(b''.join(fragments))
+                            message_opcode = None
+                            fragments = []
+                            message_size = 0
+                    elif opcode == wsframe.OPCODE_BINARY:
+                        if fin:
+                            on_binary(payload)
+                        else:
+                            message_opcode = opcode
+                            fragments = [payload.tobytes()]
+                            message_size = len(payload)
+                    elif opcode == wsframe.OPCODE_TEXT:
+                        if not fin:
+                            message_opcode = opcode
+                            fragments = []
+                            message_size = len(payload)
+                    elif opcode == wsframe.OPCODE_PING:
+                        self._send_frame(
+                            [payload.tobytes()], wsframe.OPCODE_PONG
+                        )
+                    elif opcode == wsframe.OPCODE_CLOSE:
+                        if not self._closing:
+                            self._send_close(payload[:2].tobytes())
+                        else:
+                            self.close_socket()
+                        return
+                    payload.release()
+
+                if start == end:
+                    start = end = 0
+                    if len(buffer) > base_size:
+                        # Don't hold on to a large buffer between frames
+                        pool.release(buffer)
+                        buffer = pool.acquire(recv_size)
+                elif end == len(buffer):
+                    # Move the incomplete frame to the start of a buffer
+                    remaining = end - start
+                    needed = wsframe.frame_size(buffer, start, end) or 0
+                    if needed > len(buffer):
+                        new_buffer = pool.acquire(needed)
+                        with memoryview(buffer) as view:
+                            new_buffer[:remaining] = view[start:end]
+                        pool.release(buffer)
+                        buffer = new_buffer
+                    else:
+                        with memoryview(buffer) as view:
+                            view[:remaining] = view[start:end]
+                    start = 0
+                    end = remaining
+
+                with memoryview(buffer) as view:
+                    received = recv_into(view[end:])
+                if not received:
+                    if not self._closing:
+                        self.error = 'connection closed unexpectedly'
+                    return
+                end += received
+        finally:
+            pool.release(buffer)
+
+    def _send_frame(self, buffers, opcode=wsframe.OPCODE_BINARY):
+        """Send a single frame."""
+        frame = wsframe.build_frame(buffers, opcode)
+        with self._send_lock:
+            wsframe.send_vectored(self.sock, frame)
+
+    def _send_close(self, status=None):
+        """Send a close frame, and shut down if there is no response."""
+        self._closing = True
+        if status is None:
+            status = struct.pack('!H', 1000)
+        try:
+            self._send_frame([status], wsframe.OPCODE_CLOSE)
+        except OSError:
+            log.debug('unable to send close frame')
+        timer = Timer(self.close_timeout, self._close_timed_out)
+        timer.daemon = True
+        timer.start()
+
+    def _close_timed_out(self):
+        """Called if the close handshake didn't finish in time."""
+        if self.is_alive():
+            log.warning(
+                'no close response in %ss, shutting down socket',
+                self.close_timeout
+            )
+            self.close_socket()
+
+    def send(self, data):
+        """Send binary message (low level interface)."""
+        self._send_frame([data])
+
+    def send_many(self, messages):
+        """Send a number of binary messages with a single write."""
+        frames = []
+        for data in messages:
+            frames.extend(wsframe.build_frame([data]))
+        with self._send_lock:
+            wsframe.send_vectored(self.sock, frames)
+
+    def send_buffers(self, buffers):
+        """Send a binary message from a list of buffers, without joining."""
+        self._send_frame(buffers)
+
+    def close(self):
+        """Start a graceful close."""
+        if self.running and not self._closing:
+            self._send_close()
+
+    def close_socket(self):
+        """Close the socket, which stops the thread."""
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def benchmark(transport, packets=20000, size=1024, url=None,
+              route_views=False):
+    """
+    Time echoing route data through a server, with a given transport.
+
+    Uses a local FakeServer if `url` isn't given, which needs a source
+    checkout. Returns the number of packets per second.
+
+    """
+    from threading import Event
+
+    from .client import M2MClient
+    from .dispatcher import expose
+    from .packets import PacketType
+
+    done = Event()
+
+    class EchoClient(M2MClient):
+        received = 0
+
+        @expose(PacketType.route)
+        def handle_route(self, port, data):
+            self.received += 1
+            if self.received == packets:
+                done.set()
+
+    server = None
+    if url is None:
+        try:
+            from tests.fakeserver import FakeServer
+        except ImportError:
+            raise ValueError(
+                'the fake server needs a source checkout, pass a url'
+            )
+        server = FakeServer()
+        server.start()
+        url = server.url
+    try:
+        client = EchoClient(
+            url, 'bench', 'bench',
+            transport=transport,
+            route_views=route_views
+        )
+        with client:
+            data = b'x' * size
+            start = time.perf_counter()
+            for _ in range(packets):
+                client.send_data(1, data)
+            done.wait(60)
+            elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.close()
+    return client.received / elapsed
+
+
+def main(argv=None):
+    """Compare the lomond and lean transports, and route views."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m m2mclient.transport')
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--url', default=None)
+    args = parser.parse_args(argv)
+    runs = [
+        ('lomond', 'lomond', False),
+        ('lean', 'lean', False),
+        ('lean+views', 'lean', True),
+    ]
+    for name, transport, route_views in runs:
+        rate = benchmark(
+            transport, args.packets, args.size, args.url, route_views
+        )
+        print('{:<12}{:>10.0f} packets/s'.format(name, rate))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,201 @@
+"""
+Low level WebSocket framing.
+
+Builds client (masked) frames from a list of buffers, and writes them
+with vectored `socket.sendmsg` calls, so a large payload doesn't need to
+be joined with its packet header and trailer before sending. Each call
+passes at most IOV_MAX buffers, which is the most the OS will accept.
+Frames are parsed in place from a receive buffer.
+
+"""
+
+import base64
+import hashlib
+import os
+import struct
+
+try:
+    from wsaccel.xormask import XorMaskerSimple as Masker
+except ImportError:
+    Masker = None
+
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    # The POSIX minimum is 16, but 1024 is usual
+    IOV_MAX = 1024
+
+# Appended to the client's key to make the Sec-WebSocket-Accept header
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class FrameError(Exception):
+    """The peer sent an invalid frame."""
+
+
+class PythonMasker(object):
+    """Masks data in chunks, used if wsaccel isn't available."""
+
+    def __init__(self, mask_key):
+        self.mask_key = mask_key
+        self.offset = 0
+
+    def process(self, data):
+        size = len(data)
+        if not size:
+            return b''
+        start = self.offset % 4
+        mask = (self.mask_key * (size // 4 + 2))[start:start + size]
+        self.offset += size
+        return (
+            int.from_bytes(data, 'little') ^ int.from_bytes(mask, 'little')
+        ).to_bytes(size, 'little')
+
+
+if Masker is None:
+    Masker = PythonMasker
+
+
+def frame_header(length, mask_key=None, opcode=OPCODE_BINARY, fin=True):
+    """Build a frame header for a payload of `length` bytes."""
+    first = (0x80 if fin else 0) | opcode
+    mask_bit = 0x80 if mask_key is not None else 0
+    if length < 126:
+        header = struct.pack('!BB', first, mask_bit | length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', first, mask_bit | 126, length)
+    else:
+        header = struct.pack('!BBQ', first, mask_bit | 127, length)
+    if mask_key is not None:
+        header += mask_key
+    return header
+
+
+def build_frame(buffers, opcode=OPCODE_BINARY, mask=True):
+    """
+    Build a frame from a list of payload buffers.
+
+    Returns a list of buffers (the header, then the masked payload
+    buffers) to be written in order.
+
+    """
+    length = sum(len(buffer) for buffer in buffers)
+    if not mask:
+        return [frame_header(length, opcode=opcode)] + list(buffers)
+    mask_key = os.urandom(4)
+    masker = Masker(mask_key)
+    frame = [frame_header(length, mask_key, opcode=opcode)]
+    frame.extend(masker.process(buffer) for buffer in buffers)
+    return frame
+
+
+def send_vectored(sock, buffers):
+    """Write all buffers to a socket, with as few system calls as possible."""
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    index = 0
+    try:
+        while index < len(buffers):
+            sent = sock.sendmsg(buffers[index:index + IOV_MAX])
+            while sent:
+                first = buffers[index]
+                if sent >= len(first):
+                    sent -= len(first)
+                    index += 1
+                else:
+                    buffers[index] = first[sent:]
+                    sent = 0
+    except (AttributeError, NotImplementedError):
+        # SSL sockets don't support sendmsg
+        sock.sendall(b''.join(buffers[index:]))
+
+
+def parse_frame(buffer, start, end, max_size=None, copy=True):
+    """
+    Parse a frame from `buffer[start:end]`.
+
+    Returns a tuple of (<fin>, <opcode>, <payload bytes>, <end of
+    frame>), or None if the buffer doesn't contain a complete frame.
+    Raises FrameError if the payload is larger than `max_size`.
+
+    If `copy` is False, the payload is a memoryview, which refers to the
+    buffer unless the frame was masked.
+
+    """
+    size = frame_size(buffer, start, end)
+    if size is None:
+        return None
+    if max_size is not None and size > max_size + 14:
+        raise FrameError('frame is too large')
+    if end - start < size:
+        return None
+    first = buffer[start]
+    second = buffer[start + 1]
+    length = second & 0x7F
+    position = start + 2
+    if length == 126:
+        position += 2
+    elif length == 127:
+        position += 8
+    mask_key = None
+    if second & 0x80:
+        mask_key = bytes(buffer[position:position + 4])
+        position += 4
+    frame_end = start + size
+    if not copy:
+        payload = memoryview(buffer)[position:frame_end]
+        if mask_key is not None:
+            payload = memoryview(Masker(mask_key).process(payload.tobytes()))
+        return bool(first & 0x80), first & 0x0F, payload, frame_end
+    with memoryview(buffer) as view:
+        payload = view[position:frame_end].tobytes()
+    if mask_key is not None:
+        payload = Masker(mask_key).process(payload)
+    return bool(first & 0x80), first & 0x0F, payload, frame_end
+
+
+def frame_size(buffer, start, end):
+    """
+    Get the size of the frame at `start`, including the header.
+
+    Returns None if there isn't enough data to know the size.
+
+    """
+    available = end - start
+    if available < 2:
+        return None
+    second = buffer[start + 1]
+    length = second & 0x7F
+    header_size = 2
+    if length == 126:
+        header_size = 4
+        if available < header_size:
+            return None
+        length = struct.unpack_from('!H', buffer, start + 2)[0]
+    elif length == 127:
+        header_size = 10
+        if available < header_size:
+            return None
+        length = struct.unpack_from('!Q', buffer, start + 2)[0]
+    if second & 0x80:
+        header_size += 4
+    return header_size + length
+
+
+def make_key():
+    """Make a random Sec-WebSocket-Key."""
+    return base64.b64encode(os.urandom(16))
+
+
+def get_accept(key):
+    """Get the Sec-WebSocket-Accept value for a key."""
+    return base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
@@ -22,7 +22,7 @@ setup(
     author_email='support@dataplicity.com',
     url='https://www.dataplicity.com',
     platforms=['any'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     include_package_data=True,
     exclude_package_data={'': ['_*', 'docs/*']},
     classifiers=classifiers,
@@ -0,0 +1,397 @@
+"""
+A minimal in-process M2M server, for tests and benchmarks.
+
+Requires a source checkout; it is not part of the installed package.
+
+This is not a real server. State is kept in memory and only enough of
+the protocol is implemented to exercise the client:
+
+- Clients are given a random identity when they join, and may take an
+  existing identity with request_identify.
+- Logins succeed, unless the server was created with a `password` that
+  doesn't match.
+- Data sent to a port with no route is echoed back in a route packet,
+  so a single client can measure round trips. Ports connected with
+  command_add_route forward data to the other node.
+- Commands the server doesn't know about get an "ok" response.
+
+For example:
+
+    with FakeServer() as server:
+        with M2MClient(server.url, 'user', 'pass') as client:
+            ...
+
+"""
+
+import logging
+import socket
+import uuid
+from itertools import count
+from threading import Lock
+from threading import Thread
+
+from m2mclient.dispatcher import Dispatcher
+from m2mclient.dispatcher import PacketFormatError
+from m2mclient.dispatcher import expose
+from m2mclient.packets import M2MPacket
+from m2mclient.packets import PacketType
+from m2mclient import wsframe
+
+
+log = logging.getLogger('m2m.fakeserver')
+
+
+class FakeServer(object):
+    """Listens for websocket connections on the loopback interface."""
+
+    def __init__(self, host='127.0.0.1', port=0, password=None):
+        self.password = password
+        self._listen_socket = socket.socket(
+            socket.AF_INET, socket.SOCK_STREAM
+        )
+        self._listen_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
+        )
+        self._listen_socket.bind((host, port))
+        self.host, self.port = self._listen_socket.getsockname()
+        self._lock = Lock()
+        # Identity -> connection
+        self.connections = {}
+        # (identity, port) -> (identity, port)
+        self.routes = {}
+        # Identity -> meta dict
+        self.meta = {}
+        self._port_numbers = count(1)
+        self._thread = None
+        self.packets_received = 0
+        self.packets_sent = 0
+
+    def __repr__(self):
+        return "FakeServer({!r})".format(self.url)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def url(self):
+        return "ws://{}:{}/m2m/".format(self.host, self.port)
+
+    def start(self):
+        """Start accepting connections in a thread."""
+        self._listen_socket.listen(128)
+        self._thread = Thread(
+            target=self._serve,
+            name='m2m-fakeserver',
+            daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        """Stop accepting connections, and disconnect clients."""
+        try:
+            self._listen_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listen_socket.close()
+        with self._lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            connection.close()
+        if self._thread is not None:
+            self._thread.join(1)
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _address = self._listen_socket.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = ServerConnection(self, sock)
+            Thread(
+                target=connection.run,
+                name='m2m-fakeserver-connection',
+                daemon=True
+            ).start()
+
+    def allocate_port(self):
+        """Get a new port number."""
+        with self._lock:
+            return next(self._port_numbers)
+
+    def get_connection(self, identity):
+        with self._lock:
+            return self.connections.get(identity)
+
+    def get_route(self, identity, port):
+        """Get the (identity, port) at the other end of a route."""
+        return self.routes.get((identity, port))
+
+
+class ServerConnection(Dispatcher):
+    """A single client connected to the fake server."""
+
+    def __init__(self, server, sock):
+        super(ServerConnection, self).__init__(M2MPacket, log=log)
+        self.server = server
+        self.sock = sock
+        self.identity = None
+        self._send_lock = Lock()
+        self._closed = False
+
+    def __repr__(self):
+        return "<connection {!r}>".format(self.identity)
+
+    def run(self):
+        """Handshake, then handle packets until the client goes away."""
+        try:
+            data = self._handshake()
+            if data is not None:
+                self._receive(data)
+        except (OSError, wsframe.FrameError) as error:
+            log.debug('%r closed (%s)', self, error)
+        except Exception:
+            log.exception('error in %r', self)
+        finally:
+            self._leave()
+            self.sock.close()
+
+    def _handshake(self):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                return None
+            request += chunk
+        header, _, data = request.partition(b'\r\n\r\n')
+        key = None
+        for line in header.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'sec-websocket-key':
+                key = value.strip()
+        if key is None:
+            self.sock.sendall(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+            return None
+        self.sock.sendall(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + wsframe.get_accept(key) + b'\r\n'
+            b'\r\n'
+        )
+        return data
+
+    def _receive(self, data):
+        buffer = bytearray(data)
+        start = 0
+        while True:
+            while True:
+                frame = wsframe.parse_frame(buffer, start, len(buffer))
+                if frame is None:
+                    break
+                _fin, opcode, payload, start = frame
+                if opcode == wsframe.OPCODE_BINARY:
+                    self.on_binary(payload)
+                elif opcode == wsframe.OPCODE_PING:
+                    self._send_frame([payload], wsframe.OPCODE_PONG)
+                elif opcode == wsframe.OPCODE_CLOSE:
+                    if not self._closed:
+                        self._send_frame([payload[:2]], wsframe.OPCODE_CLOSE)
+                    return
+            del buffer[:start]
+            start = 0
+            chunk = self.sock.recv(256 * 1024)
+            if not chunk:
+                return
+            buffer += chunk
+
+    def on_binary(self, data):
+        self.server.packets_received += 1
+        try:
+            packet = M2MPacket.from_bytes(data)
+        except PacketFormatError as packet_error:
+            log.warning('bad packet from client (%s)', packet_error)
+            return
+        try:
+            self.dispatch_packet(packet)
+        except Exception:
+            log.exception('error handling %r', packet)
+
+    def _send_frame(self, buffers, opcode=wsframe.OPCODE_BINARY):
+        frame = wsframe.build_frame(buffers, opcode, mask=False)
+        with self._send_lock:
+            wsframe.send_vectored(self.sock, frame)
+
+    def send(self, packet_type, **kwargs):
+        """Send a packet to the client."""
+        packet = M2MPacket.create(packet_type, **kwargs)
+        try:
+            self._send_frame(packet.as_buffers)
+        except OSError:
+            log.debug('%r unable to send %r', self, packet)
+        else:
+            self.server.packets_sent += 1
+
+    def close(self):
+        """Disconnect the client."""
+        if not self._closed:
+            self._closed = True
+            try:
+                self._send_frame([b'\x03\xe8'], wsframe.OPCODE_CLOSE)
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _join(self, identity):
+        server = self.server
+        with server._lock:
+            if self.identity is not None:
+                server.connections.pop(self.identity, None)
+            self.identity = identity
+            server.connections[identity] = self
+        self.send('set_identity', identity=identity)
+        self.send('welcome')
+
+    def _leave(self):
+        server = self.server
+        with server._lock:
+            if server.connections.get(self.identity) is self:
+                del server.connections[self.identity]
+            closed = [
+                (source, destination)
+                for source, destination in server.routes.items()
+                if source[0] == self.identity
+            ]
+            for source, destination in closed:
+                server.routes.pop(source, None)
+                server.routes.pop(destination, None)
+        for _source, (identity, port) in closed:
+            connection = server.get_connection(identity)
+            if connection is not None:
+                connection.send('notify_close', port=port)
+
+    def _respond(self, command_id, **result):
+        result['status'] = 'ok'
+        self.send('response', command_id=command_id, result=result)
+
+    def on_missing_handler(self, packet):
+        """Respond to commands that aren't implemented."""
+        if packet.type > PacketType.response:
+            self._respond(packet.command_id)
+        else:
+            log.debug('%r ignored %r', self, packet)
+
+    @expose(PacketType.request_join)
+    def handle_request_join(self):
+        self._join(uuid.uuid4().hex.encode())
+
+    @expose(PacketType.request_identify)
+    def handle_request_identify(self, uuid):
+        self._join(uuid)
+
+    @expose(PacketType.request_login)
+    def handle_request_login(self, username, password):
+        expected = self.server.password
+        if expected is None or password == expected.encode():
+            self.send('notify_login_success', user=username)
+        else:
+            self.send('notify_login_fail', message=b'invalid password')
+
+    @expose(PacketType.request_leave)
+    def handle_request_leave(self):
+        self.close()
+
+    @expose(PacketType.ping)
+    def handle_ping(self, data):
+        self.send('pong', data=data)
+
+    @expose(PacketType.keep_alive)
+    def handle_keep_alive(self):
+        pass
+
+    @expose(PacketType.request_send)
+    def handle_request_send(self, port, data):
+        self._forward('route', port, data)
+
+    @expose(PacketType.request_send_control)
+    def handle_request_send_control(self, port, data):
+        self._forward('route_control', port, data)
+
+    def _forward(self, packet_type, port, data):
+        route = self.server.get_route(self.identity, port)
+        if route is None:
+            # Loopback
+            self.send(packet_type, port=port, data=data)
+            return
+        identity, destination_port = route
+        connection = self.server.get_connection(identity)
+        if connection is not None:
+            connection.send(packet_type, port=destination_port, data=data)
+
+    @expose(PacketType.request_close)
+    def handle_request_close(self, port):
+        server = self.server
+        with server._lock:
+            route = server.routes.pop((self.identity, port), None)
+            if route is not None:
+                server.routes.pop(route, None)
+        if route is not None:
+            identity, destination_port = route
+            connection = server.get_connection(identity)
+            if connection is not None:
+                connection.send('notify_close', port=destination_port)
+
+    @expose(PacketType.command_add_route)
+    def handle_command_add_route(self, command_id, node1, port1, node2,
+                                 port2, requester, forwarded):
+        server = self.server
+        if port1 < 0:
+            port1 = server.allocate_port()
+        if port2 < 0:
+            port2 = server.allocate_port()
+        with server._lock:
+            server.routes[(node1, port1)] = (node2, port2)
+            server.routes[(node2, port2)] = (node1, port1)
+        for node, port in ((node1, port1), (node2, port2)):
+            connection = server.get_connection(node)
+            if connection is not None:
+                connection.send('notify_open', port=port)
+        self._respond(command_id, port1=port1, port2=port2)
+
+    @expose(PacketType.command_send_instruction)
+    def handle_command_send_instruction(self, command_id, node, data):
+        connection = self.server.get_connection(node)
+        if connection is not None:
+            connection.send('instruction', sender=self.identity, data=data)
+        self._respond(command_id)
+
+    @expose(PacketType.command_check_nodes)
+    def handle_command_check_nodes(self, command_id, nodes):
+        with self.server._lock:
+            online = [
+                node for node in nodes
+                if node.encode() in self.server.connections
+            ]
+        self._respond(command_id, nodes=online)
+
+    @expose(PacketType.command_get_identities)
+    def handle_command_get_identities(self, command_id, nodes):
+        self.handle_command_check_nodes(command_id, nodes)
+
+    @expose(PacketType.command_set_meta)
+    def handle_command_set_meta(self, command_id, requester, node, key,
+                                value):
+        with self.server._lock:
+            meta = self.server.meta.setdefault(node, {})
+            meta[key.decode()] = value.decode()
+        self._respond(command_id)
+
+    @expose(PacketType.command_get_meta)
+    def handle_command_get_meta(self, command_id, requester, node):
+        with self.server._lock:
+            meta = dict(self.server.meta.get(node, {}))
+        self._respond(command_id, meta=meta)
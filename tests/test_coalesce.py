@@ -0,0 +1,186 @@
+import time
+from threading import Condition
+from threading import Lock
+from threading import Thread
+
+from m2mclient import bencode
+from m2mclient.coalesce import WriteCoalescer
+from m2mclient.flowcontrol import FlowControl
+
+
+class Recorder(object):
+    """Records data sent by a WriteCoalescer."""
+
+    def __init__(self):
+        self.sent = []
+        self._lock = Lock()
+
+    def __call__(self, port, data, timeout=None):
+        with self._lock:
+            self.sent.append((port, data))
+
+    def get_data(self, port):
+        with self._lock:
+            return b''.join(
+                data for sent_port, data in self.sent if sent_port == port
+            )
+
+
+def wait_for(condition, timeout=2):
+    give_up = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < give_up, 'timed out'
+        time.sleep(0.001)
+
+
+def test_small_writes_are_merged():
+    recorder = Recorder()
+    coalescer = WriteCoalescer(recorder, delay=0.05)
+    for char in b'abcdef':
+        coalescer.write(1, bytes([char]))
+    wait_for(lambda: recorder.sent)
+    coalescer.close()
+    assert recorder.sent == [(1, b'abcdef')]
+
+
+def test_max_bytes_sends_immediately():
+    recorder = Recorder()
+    coalescer = WriteCoalescer(recorder, delay=10, max_bytes=4)
+    coalescer.write(1, b'ab')
+    coalescer.write(1, b'cd')
+    coalescer.write(1, b'efgh')
+    assert recorder.sent == [(1, b'abcd'), (1, b'efgh')]
+    coalescer.close()
+
+
+def test_order_is_kept_across_ports():
+    recorder = Recorder()
+    coalescer = WriteCoalescer(recorder, delay=0.001, max_bytes=8)
+    expected = {1: [], 2: []}
+    for index in range(500):
+        port = 1 + index % 2
+        data = str(index).encode() + b','
+        expected[port].append(data)
+        coalescer.write(port, data)
+    coalescer.close()
+    for port, writes in expected.items():
+        assert recorder.get_data(port) == b''.join(writes)
+
+
+def test_write_during_send_is_not_stranded():
+    sent = []
+
+    def send(port, data, timeout=None):
+        sent.append(data)
+        if data == b'AAAA':
+            # Another writer while this port is being sent
+            coalescer.write(port, b'BBBB')
+
+    coalescer = WriteCoalescer(send, delay=10, max_bytes=4)
+    coalescer.write(1, b'AAAA')
+    assert sent == [b'AAAA', b'BBBB']
+    assert not coalescer._outgoing
+    assert not coalescer._sending
+    coalescer.close()
+
+
+class RacingCondition(Condition):
+    """
+    Writes to a port when the lock is released with the port marked as
+    sending but nothing queued, which would strand the data.
+
+    """
+
+    def __init__(self, coalescer, port, data):
+        super(RacingCondition, self).__init__()
+        self.coalescer = coalescer
+        self.port = port
+        self.data = data
+        self.raced = False
+
+    def __exit__(self, *exc_info):
+        super(RacingCondition, self).__exit__(*exc_info)
+        coalescer = self.coalescer
+        if (
+            not self.raced and
+            self.port in coalescer._sending and
+            self.port not in coalescer._outgoing
+        ):
+            self.raced = True
+            thread = Thread(
+                target=coalescer.write,
+                args=(self.port, self.data)
+            )
+            thread.start()
+            thread.join()
+
+
+def test_write_after_empty_check_is_not_stranded():
+    recorder = Recorder()
+    coalescer = WriteCoalescer(recorder, delay=10, max_bytes=4)
+    condition = coalescer._condition = RacingCondition(coalescer, 1, b'BBBB')
+    coalescer.write(1, b'AAAA')
+    expected = b'AAAABBBB' if condition.raced else b'AAAA'
+    assert recorder.get_data(1) == expected
+    assert not coalescer._outgoing
+    assert not coalescer._sending
+
+
+def test_flush_and_close_send_outgoing():
+    recorder = Recorder()
+    coalescer = WriteCoalescer(recorder, delay=10)
+    coalescer.write(1, b'buffered')
+    with coalescer._condition:
+        coalescer._queue(2, b'outgoing')
+    coalescer.flush()
+    assert sorted(recorder.sent) == [(1, b'buffered'), (2, b'outgoing')]
+    with coalescer._condition:
+        coalescer._queue(3, b'queued')
+    coalescer.write(4, b'written')
+    coalescer.close()
+    assert recorder.get_data(3) == b'queued'
+    assert recorder.get_data(4) == b'written'
+
+
+def test_starved_port_does_not_block_other_ports():
+    recorder = Recorder()
+    controls = []
+    flow_control = FlowControl(
+        lambda port, data: recorder(port, data),
+        lambda port, data: controls.append((port, data)),
+        window=8
+    )
+    coalescer = WriteCoalescer(flow_control.write, delay=0.001)
+    coalescer.write(1, b'0123456789abcdef')
+    wait_for(lambda: recorder.get_data(1) == b'01234567')
+    coalescer.write(2, b'other')
+    wait_for(lambda: recorder.get_data(2) == b'other')
+    assert recorder.get_data(1) == b'01234567'
+
+    # The peer grants more credit
+    flow_control.on_control(1, bencode.encode({'credit': 8}))
+    coalescer.resume(1)
+    wait_for(lambda: recorder.get_data(1) == b'0123456789abcdef')
+    coalescer.close()
+
+
+def test_close_gives_up_without_credit():
+    flow_control = FlowControl(
+        lambda port, data: None,
+        lambda port, data: None,
+        window=4
+    )
+    coalescer = WriteCoalescer(flow_control.write, delay=10)
+    coalescer.write(1, b'too much data')
+    start = time.monotonic()
+    coalescer.close(timeout=0.1)
+    assert time.monotonic() - start < 1
+
+
+def test_discard_drops_data():
+    recorder = Recorder()
+    coalescer = WriteCoalescer(recorder, delay=10)
+    coalescer.write(1, b'data')
+    coalescer.discard(1)
+    coalescer.close()
+    assert recorder.sent == []
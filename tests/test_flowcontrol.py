@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from m2mclient import bencode
+from m2mclient import errors
+from m2mclient.flowcontrol import FlowControl
+
+
+class Channel(object):
+    """Records data and control packets sent by a FlowControl."""
+
+    def __init__(self, window=100):
+        self.data = []
+        self.controls = []
+        self.flow_control = FlowControl(
+            lambda port, data: self.data.append((port, data)),
+            lambda port, data: self.controls.append(
+                (port, bencode.decode(data))
+            ),
+            window=window
+        )
+
+
+def test_write_uses_credit():
+    channel = Channel()
+    flow_control = channel.flow_control
+    flow_control.write(1, b'x' * 60)
+    flow_control.write(2, b'x' * 100)
+    assert flow_control._send_credit == {1: 40, 2: 0}
+
+
+def test_timeout_carries_remaining_data():
+    channel = Channel()
+    with pytest.raises(errors.FlowControlTimeout) as error:
+        channel.flow_control.write(1, b'a' * 90 + b'b' * 20, timeout=0.01)
+    assert channel.data == [(1, b'a' * 90 + b'b' * 10)]
+    assert error.value.remaining == b'b' * 10
+
+
+def test_credit_wakes_writer():
+    channel = Channel()
+    flow_control = channel.flow_control
+    flow_control.write(1, b'x' * 100)
+    thread = threading.Thread(target=flow_control.write, args=(1, b'more'))
+    thread.start()
+    time.sleep(0.05)
+    assert thread.is_alive()
+    flow_control.on_control(1, bencode.encode({'credit': 50}))
+    thread.join(1)
+    assert not thread.is_alive()
+    assert channel.data[-1] == (1, b'more')
+    assert flow_control._send_credit[1] == 46
+
+
+def test_bad_control_is_ignored():
+    channel = Channel()
+    flow_control = channel.flow_control
+    for data in (b'nonsense', bencode.encode([1]),
+                 bencode.encode({'credit': -5})):
+        flow_control.on_control(1, data)
+    assert 1 not in flow_control._send_credit
+
+
+def test_close_port_wakes_writer():
+    channel = Channel()
+    flow_control = channel.flow_control
+    flow_control.write(1, b'x' * 100)
+    raised = []
+
+    def write():
+        try:
+            flow_control.write(1, b'more')
+        except errors.ConnectionError as error:
+            raised.append(error)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    time.sleep(0.05)
+    flow_control.close_port(1)
+    thread.join(1)
+    assert not thread.is_alive()
+    assert len(raised) == 1
+
+
+def test_credit_is_granted_in_batches():
+    channel = Channel()
+    flow_control = channel.flow_control
+    assert flow_control.received(1, 80)
+    flow_control.consumed(1, 30)
+    assert channel.controls == []
+    flow_control.consumed(1, 30)
+    assert channel.controls == [(1, {'credit': 60})]
+    assert flow_control.get_buffered(1) == 20
+
+
+def test_window_violation():
+    channel = Channel()
+    flow_control = channel.flow_control
+    assert flow_control.received(1, 100)
+    assert not flow_control.received(1, 1)
+    assert flow_control.violations == 1
+    assert flow_control.get_buffered(1) == 100
@@ -0,0 +1,79 @@
+"""
+Import time of the client.
+
+CLI tools and hooks that start a new process for each invocation pay
+for `import m2mclient` every time, so modules that are slow to import
+or only sometimes needed (lomond, ssl, shared memory) are imported when
+first used. These tests import the client with `python -X importtime`
+in fresh interpreters, and check the median time against a budget in
+milliseconds (set M2M_IMPORT_BUDGET to change it).
+
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+
+MODULE = 'm2mclient.client'
+BUDGET = float(os.environ.get('M2M_IMPORT_BUDGET', 60))
+RUNS = 5
+
+# Modules that importing the client shouldn't pull in
+DEFERRED_MODULES = (
+    'lomond',
+    'ssl',
+    'multiprocessing.shared_memory',
+    'm2mclient.spool',
+    'm2mclient.transport',
+)
+
+
+def measure(module=MODULE):
+    """
+    Import `module` in a new interpreter.
+
+    Returns a dict of module name -> (<self us>, <cumulative us>) for
+    every module that was imported.
+
+    """
+    env = dict(os.environ)
+    package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (package_path, env.get('PYTHONPATH')) if path
+    )
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True
+    )
+    times = {}
+    for line in process.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            self_us, cumulative_us, name = line[12:].split('|')
+            times[name.strip()] = (int(self_us), int(cumulative_us))
+        except ValueError:
+            # The header line
+            continue
+    return times
+
+
+def test_import_time_within_budget():
+    totals = [measure()[MODULE][1] / 1000 for _ in range(RUNS)]
+    median = statistics.median(totals)
+    assert median <= BUDGET, (
+        'importing {} took {:.1f}ms (budget {:.0f}ms)'.format(
+            MODULE, median, BUDGET
+        )
+    )
+
+
+def test_deferred_modules_not_imported():
+    times = measure()
+    imported = [name for name in DEFERRED_MODULES if name in times]
+    assert not imported
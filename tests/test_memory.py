@@ -0,0 +1,119 @@
+"""
+Leak regression tests.
+
+The soak sends route data and commands through a FakeServer, and
+compares tracemalloc snapshots taken after a warm up and at the end, to
+check the memory allocated by the client stays flat. The packet count
+is kept small so the suite runs quickly; set M2M_SOAK_PACKETS for a
+long run (1000000 takes around 15 minutes).
+
+"""
+
+import gc
+import os
+import threading
+import tracemalloc
+
+from m2mclient.client import M2MClient
+from m2mclient.dispatcher import expose
+from m2mclient.packets import PacketType
+
+from tests.fakeserver import FakeServer
+
+
+PACKETS = int(os.environ.get('M2M_SOAK_PACKETS', 4000))
+# Allowed growth in bytes
+LIMIT = 1024 * 1024
+
+
+class SoakClient(M2MClient):
+    received = 0
+
+    def __init__(self, *args, **kwargs):
+        super(SoakClient, self).__init__(*args, **kwargs)
+        self.received_condition = threading.Condition()
+
+    @expose(PacketType.route)
+    def handle_route(self, port, data):
+        with self.received_condition:
+            self.received += 1
+            self.received_condition.notify()
+
+
+def soak(packets, size=64, batch_size=500, warmup=None, transport='lean'):
+    """
+    Echo `packets` route packets, with a command after each batch.
+
+    Returns the tracemalloc differences between the end of the warm up
+    and the end of the run, and the client's memory usage.
+
+    """
+    if warmup is None:
+        warmup = packets // 4
+    # Only count allocations made by the client
+    filters = [
+        tracemalloc.Filter(False, '*fakeserver.py'),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ]
+    data = b'x' * size
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(10)
+    baseline = None
+    try:
+        with FakeServer() as server:
+            client = SoakClient(
+                server.url, 'soak', 'soak', transport=transport
+            )
+            with client:
+                identity = client.get_identity()
+                sent = 0
+                while sent < packets:
+                    count = min(batch_size, packets - sent)
+                    for _ in range(count):
+                        client.send_data(1, data)
+                    sent += count
+                    client.get_meta(identity).get()
+                    with client.received_condition:
+                        assert client.received_condition.wait_for(
+                            lambda: client.received >= sent, 10
+                        ), 'server stopped echoing after {} packets'.format(
+                            client.received
+                        )
+                    if baseline is None and sent >= warmup:
+                        gc.collect()
+                        baseline = tracemalloc.take_snapshot()
+                # Compare while the client is still connected
+                gc.collect()
+                final = tracemalloc.take_snapshot()
+                usage = client.get_memory_usage()
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    differences = final.filter_traces(filters).compare_to(
+        baseline.filter_traces(filters), 'lineno'
+    )
+    return differences, usage
+
+
+def test_soak_memory_is_flat():
+    differences, usage = soak(PACKETS)
+    growth = sum(difference.size_diff for difference in differences)
+    assert growth <= LIMIT, 'memory grew by {} bytes\n{}'.format(
+        growth, '\n'.join(str(difference) for difference in differences[:10])
+    )
+    # Nothing left pending once every packet has come back
+    assert usage['command_events']['items'] == 0
+    # Completed deadlines are compacted lazily, but stay bounded
+    assert usage['command_deadlines']['items'] <= 64
+    assert usage['identity_queue']['items'] == 0
+
+
+def test_get_memory_usage():
+    with FakeServer() as server:
+        with M2MClient(server.url, 'user', 'pass') as client:
+            client.get_identity()
+            usage = client.get_memory_usage()
+    for name in ('command_events', 'dispatcher_handlers', 'decode_cache'):
+        assert usage[name]['items'] >= 0
+        assert usage[name]['bytes'] > 0
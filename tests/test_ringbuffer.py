@@ -0,0 +1,122 @@
+import os
+import subprocess
+import sys
+import time
+
+from m2mclient.ringbuffer import HEADER_SIZE
+from m2mclient.ringbuffer import RingBuffer
+from m2mclient.ringbuffer import RouteReader
+from m2mclient.ringbuffer import RouteSink
+from m2mclient.ringbuffer import SharedRingBuffer
+
+
+def make_ring(capacity=64):
+    return RingBuffer(bytearray(HEADER_SIZE + capacity))
+
+
+def test_records_wrap_around():
+    ring = make_ring()
+    records = [bytes([index]) * (index % 20 + 1) for index in range(200)]
+    for record in records:
+        assert ring.put(record)
+        assert ring.get() == record
+    assert ring.get() is None
+    assert ring.used == 0
+    assert ring.dropped == 0
+
+
+def test_record_in_parts():
+    ring = make_ring()
+    assert ring.put(b'ab', memoryview(b'cd'), bytearray(b'ef'))
+    assert ring.get() == b'abcdef'
+
+
+def test_full_ring_drops_new_records():
+    ring = make_ring()
+    assert ring.put(b'x' * 40)
+    assert not ring.put(b'y' * 40)
+    assert ring.dropped == 1
+    assert ring.get() == b'x' * 40
+    assert ring.put(b'y' * 40)
+    assert ring.get() == b'y' * 40
+
+
+def test_can_fit():
+    ring = make_ring()
+    assert ring.can_fit(60)
+    assert not ring.can_fit(61)
+
+
+def test_peek_many():
+    ring = make_ring(1024)
+    for index in range(10):
+        ring.put(bytes([index]) * 10)
+    records, position = ring.peek_many(25)
+    assert records == [bytes([index]) * 10 for index in range(3)]
+    records, position = ring.peek_many(1024, max_records=4)
+    assert len(records) == 4
+    ring.advance(position)
+    assert ring.get() == bytes([4]) * 10
+    # A position that was already removed is ignored
+    ring.advance(position)
+    assert ring.get() == bytes([5]) * 10
+
+
+def test_peek_many_returns_a_large_record():
+    ring = make_ring(1024)
+    ring.put(b'x' * 100)
+    records, _position = ring.peek_many(10)
+    assert records == [b'x' * 100]
+
+
+def test_route_sink_and_reader():
+    ring = SharedRingBuffer(size=4096)
+    try:
+        sink = RouteSink(ring, ports=[1])
+        assert sink.accepts(1)
+        assert not sink.accepts(2)
+        assert sink.write(1, b'data')
+        reader = RouteReader(ring.name)
+        try:
+            assert reader.read() == (1, b'data')
+            assert reader.read() is None
+        finally:
+            reader.close()
+    finally:
+        ring.close()
+
+
+READER = """
+import sys
+from m2mclient.ringbuffer import RouteReader
+reader = RouteReader(sys.argv[1])
+print(reader.read(timeout=5))
+reader.close()
+"""
+
+
+def test_reader_process_does_not_unlink():
+    ring = SharedRingBuffer(size=4096)
+    try:
+        RouteSink(ring).write(7, b'hello')
+        env = dict(os.environ)
+        package_path = os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))
+        )
+        env['PYTHONPATH'] = package_path
+        process = subprocess.run(
+            [sys.executable, '-c', READER, ring.name],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True
+        )
+        assert process.stdout.strip() == b"(7, b'hello')"
+        assert b'resource_tracker' not in process.stderr
+        # The segment still exists once the reader (and its resource
+        # tracker) has gone
+        time.sleep(0.2)
+        reader = RouteReader(ring.name)
+        reader.close()
+    finally:
+        ring.close()
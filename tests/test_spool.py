@@ -0,0 +1,151 @@
+import pytest
+
+from m2mclient.packets import M2MPacket
+from m2mclient.packets import PacketType
+from m2mclient.spool import DROP_OLD
+from m2mclient.spool import OutboundSpool
+
+
+def send_packet(port, data):
+    return M2MPacket.create('request_send', port=port, data=data)
+
+
+def decode(batches):
+    return [
+        M2MPacket.from_bytes(packet_bytes)
+        for packets in batches
+        for _type, packet_bytes in packets
+    ]
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = OutboundSpool(str(tmp_path / 'spool'), size=4096)
+    yield spool
+    spool.close()
+
+
+def test_route_data_is_merged(spool):
+    assert spool.put(send_packet(1, b'a'))
+    assert spool.put(send_packet(1, b'b'))
+    assert spool.put(send_packet(2, b'c'))
+    assert spool.put(M2MPacket.create('request_close', port=1))
+    assert spool.put(M2MPacket.create('log', text=b'offline'))
+    batches = []
+    assert spool.flush(batches.append) == 4
+    packets = decode(batches)
+    assert [packet.type for packet in packets] == [
+        PacketType.request_send,
+        PacketType.request_send,
+        PacketType.request_close,
+        PacketType.log,
+    ]
+    assert (packets[0].port, packets[0].data) == (1, b'ab')
+    assert (packets[1].port, packets[1].data) == (2, b'c')
+    assert spool.used == 0
+
+
+def test_commands_and_keep_alives_are_not_spooled(spool):
+    command = M2MPacket.create(
+        'command_set_meta',
+        command_id=1,
+        requester=b'node',
+        node=b'node',
+        key=b'key',
+        value=b'value'
+    )
+    keep_alive = M2MPacket.create('keep_alive')
+    ping = M2MPacket.create('ping', data=b'ping')
+    for packet in (command, keep_alive, ping):
+        assert not spool.put(packet)
+    spool.put(send_packet(1, b'backlog'))
+    for packet in (command, keep_alive, ping):
+        assert not spool.put_if_pending(packet)
+    batches = []
+    assert spool.flush(batches.append) == 1
+
+
+def test_put_if_pending_keeps_order(spool):
+    assert not spool.put_if_pending(send_packet(1, b'now'))
+    spool.put(send_packet(1, b'first'))
+    assert spool.put_if_pending(send_packet(1, b'second'))
+    batches = []
+    spool.flush(batches.append)
+    assert [packet.data for packet in decode(batches)] == [b'firstsecond']
+    assert not spool.put_if_pending(send_packet(1, b'empty again'))
+
+
+def test_full_spool_drops_new(spool):
+    data = b'x' * 1000
+    while spool.put(send_packet(1, data)):
+        pass
+    assert spool.dropped == 1
+
+
+def test_drop_old_makes_room(tmp_path):
+    spool = OutboundSpool(str(tmp_path / 'spool'), size=4096, policy=DROP_OLD)
+    try:
+        for index in range(10):
+            assert spool.put(send_packet(index, b'x' * 1000))
+        # Larger than the whole spool
+        assert not spool.put(send_packet(99, b'x' * 5000))
+        batches = []
+        spool.flush(batches.append)
+        ports = [packet.port for packet in decode(batches)]
+        assert ports[-1] == 9
+        assert 0 not in ports
+    finally:
+        spool.close()
+
+
+def test_batches_are_capped_by_records(tmp_path):
+    spool = OutboundSpool(
+        str(tmp_path / 'spool'),
+        size=64 * 1024,
+        batch_records=100
+    )
+    try:
+        for index in range(1200):
+            assert spool.put(send_packet(index % 2, b'x'))
+        batches = []
+        assert spool.flush(batches.append) == 1200
+        assert len(batches) == 12
+        assert max(len(packets) for packets in batches) == 100
+    finally:
+        spool.close()
+
+
+def test_failed_send_keeps_data(spool):
+    spool.put(send_packet(1, b'data'))
+
+    def send(packets):
+        raise OSError('offline')
+
+    with pytest.raises(OSError):
+        spool.flush(send)
+    batches = []
+    assert spool.flush(batches.append) == 1
+
+
+def test_new_session_discards_old_data(tmp_path):
+    path = str(tmp_path / 'spool')
+    spool = OutboundSpool(path, size=4096)
+    spool.set_session(b'first')
+    spool.put(send_packet(1, b'data'))
+    spool.close()
+
+    # Resumed session
+    spool = OutboundSpool(path, size=4096)
+    assert spool.session == b'first'
+    assert spool.set_session(b'first') == 0
+    assert spool.used
+    spool.close()
+
+    # Different session
+    spool = OutboundSpool(path, size=4096)
+    assert spool.set_session(b'second') > 0
+    assert spool.used == 0
+    assert spool.session == b'second'
+    batches = []
+    assert spool.flush(batches.append) == 0
+    spool.close()
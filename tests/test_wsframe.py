@@ -0,0 +1,76 @@
+import socket
+import threading
+
+from m2mclient import wsframe
+
+
+class RecordingSocket(object):
+    """Accepts part of what is sent, and checks the number of buffers."""
+
+    def __init__(self, max_sent=1000):
+        self.max_sent = max_sent
+        self.received = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        assert len(buffers) <= wsframe.IOV_MAX
+        self.calls += 1
+        data = b''.join(buffers)[:self.max_sent]
+        self.received += data
+        return len(data)
+
+
+def test_send_vectored_slices_buffers():
+    buffers = [bytes([index % 256]) * 3 for index in range(5000)]
+    sock = RecordingSocket()
+    wsframe.send_vectored(sock, buffers)
+    assert sock.received == b''.join(buffers)
+    assert sock.calls >= 5000 * 3 // 1000
+
+
+def test_many_frames_over_a_socket():
+    frames = []
+    for index in range(1500):
+        frames.extend(wsframe.build_frame([b'%i' % index], mask=False))
+    expected = b''.join(frames)
+    sender, receiver = socket.socketpair()
+    received = bytearray()
+
+    def receive():
+        while len(received) < len(expected):
+            chunk = receiver.recv(65536)
+            if not chunk:
+                break
+            received.extend(chunk)
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    try:
+        wsframe.send_vectored(sender, frames)
+        thread.join(5)
+    finally:
+        sender.close()
+        receiver.close()
+    assert received == expected
+    start = 0
+    for index in range(1500):
+        _fin, opcode, payload, start = wsframe.parse_frame(
+            received, start, len(received)
+        )
+        assert opcode == wsframe.OPCODE_BINARY
+        assert payload == b'%i' % index
+
+
+def test_ssl_socket_falls_back_to_sendall():
+    class SSLSocket(object):
+        sent = b''
+
+        def sendmsg(self, buffers):
+            raise NotImplementedError
+
+        def sendall(self, data):
+            self.sent += data
+
+    sock = SSLSocket()
+    wsframe.send_vectored(sock, [b'abc', b'', bytearray(b'def')])
+    assert sock.sent == b'abcdef'